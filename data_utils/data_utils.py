@@ -1,3 +1,4 @@
+import hashlib
 import pickle
 
 from data_utils.fasta import FASTA
@@ -25,6 +26,17 @@ def read_fastq_files(files):
         return FASTQ(files)
     raise ValueError(f"Invalid argument type of {type(files)}. Must be str or list")
 
+def sequence_checksum(sequences, *params):
+    """
+        SHA-1 hex digest of an iterable of sequences (e.g. the fragments of FASTA objects) and of any parameters they
+        were processed with. Used to key on-disk caches, so a changed FASTA or setting triggers a rebuild.
+    """
+    digest = hashlib.sha1(repr(params).encode() if params else b"")
+    for seq in sequences:
+        digest.update(seq.encode())
+        digest.update(b"#")
+    return digest.hexdigest()
+
 def save_object_to_file(obj, filename):
     """ Pickle a Python object so it can be loaded and re-used later. """
     with open(filename, "wb") as f:
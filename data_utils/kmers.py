@@ -0,0 +1,136 @@
+import numpy as np
+
+# 2-bit codes for each base. Anything else (N, IUPAC codes, read padding) gets
+# code 4 and invalidates every k-mer window that contains it.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    BASE_CODES[ord(base)] = code
+    BASE_CODES[ord(base.lower())] = code
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def encode_bases(seq):
+    """ Encode a DNA string as a uint8 array of 2-bit base codes (4 for non-ACGT). """
+    return BASE_CODES[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+
+
+def encode_reads(seqs):
+    """
+        Stack read sequences into a 2D uint8 matrix of base codes, one read per row.
+        Shorter reads are padded on the right with code 4, so their missing windows come out invalid.
+    """
+    width = max((len(s) for s in seqs), default=0)
+    if all(len(s) == width for s in seqs):
+        return encode_bases("".join(seqs)).reshape(len(seqs), width)
+    reads = np.full((len(seqs), width), 4, dtype=np.uint8)
+    for r, s in enumerate(seqs):
+        reads[r, :len(s)] = encode_bases(s)
+    return reads
+
+
+def kmer_codes(codes, k):
+    """
+        Turn base codes into the 2-bit packed uint64 value of every k-mer window, in one pass.
+        codes can be a single sequence (1D) or a batch of reads (2D, one read per row); windows run along the last axis.
+        Returns (kmers, valid), where valid is False for windows that contain a non-ACGT base.
+
+        Windows are built by doubling: the values of all 2w-mers are (w-mer << 2w) | (w-mer shifted by w), and k is
+        assembled from its binary digits, so the work is O(n log k) array shifts and ORs instead of a loop per k-mer.
+    """
+    assert 0 < k <= 32, "k-mers are packed into 64 bits, so k must be between 1 and 32"
+    codes = np.asarray(codes, dtype=np.uint8)
+    n = codes.shape[-1] - k + 1
+    if n <= 0:
+        shape = codes.shape[:-1] + (0,)
+        return np.zeros(shape, dtype=np.uint64), np.zeros(shape, dtype=bool)
+
+    block = (codes & 3).astype(np.uint64)
+    width = 1
+    kmers, kmer_width = None, 0
+    remaining = k
+    while True:
+        if remaining & 1:
+            if kmers is None:
+                kmers, kmer_width = block, width
+            else:
+                length = codes.shape[-1] - (kmer_width + width) + 1
+                kmers = (kmers[..., :length] << np.uint64(2 * width)) | block[..., kmer_width:kmer_width + length]
+                kmer_width += width
+        remaining >>= 1
+        if not remaining:
+            break
+        block = (block[..., :-width] << np.uint64(2 * width)) | block[..., width:]
+        width *= 2
+
+    bad = np.cumsum(codes > 3, axis=-1)
+    bad = np.concatenate((np.zeros(codes.shape[:-1] + (1,), dtype=bad.dtype), bad), axis=-1)
+    valid = bad[..., k:] == bad[..., :n]
+    return kmers, valid
+
+
+def decode_kmers(kmers, k):
+    """ ASCII bases of each 2-bit packed k-mer, as a (len(kmers), k) uint8 matrix; row.tobytes() is the k-mer string. """
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    shifts = np.uint64(2) * np.arange(k - 1, -1, -1, dtype=np.uint64)
+    return BASES[((kmers[:, None] >> shifts) & np.uint64(3)).astype(np.uint8)]
+
+
+def mix64(x, seed=0):
+    """
+        Vectorized splitmix64 finalizer: a fast, invertible 64-bit mixer applied to every uint64 in x.
+        The seed is folded in as x + (seed + 1) * 0x9E3779B97F4A7C15 (mod 2^64) before mixing, so each seed gives a
+        different but reproducible hash function.
+    """
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + np.uint64((seed + 1) * 0x9E3779B97F4A7C15 % 2**64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def minimizer_offsets(kmers, valid, w):
+    """
+        Offsets of the (w, k)-minimizers of a sequence, given its k-mers: in every window of w consecutive k-mers, the
+        one with the smallest mix64 hash (leftmost on ties). Invalid k-mers are never picked. Two sequences that share
+        w + k - 1 bases exactly share the minimizer of that stretch.
+    """
+    if len(kmers) == 0:
+        return np.zeros(0, dtype=np.int64)
+    h = mix64(kmers)
+    h[~valid] = np.iinfo(np.uint64).max
+    w = min(w, len(h))
+    windows = np.lib.stride_tricks.sliding_window_view(h, w)
+    picks = windows.argmin(axis=1) + np.arange(len(windows))
+    return np.unique(picks[valid[picks]])
+
+
+def reverse_complement_codes(codes):
+    """ Reverse complement of a sequence of base codes; non-ACGT codes (4) stay as they are. """
+    codes = np.asarray(codes, dtype=np.uint8)[..., ::-1]
+    return np.where(codes < 4, 3 - codes, codes).astype(np.uint8)
+
+
+def reverse_complement_kmers(kmers, k):
+    """
+        Reverse complement of 2-bit packed k-mers, without unpacking: complementing is flipping both bits of each base
+        (A0 <-> T3, C1 <-> G2), and the bases are reversed by swapping ever larger bit groups.
+    """
+    x = ~np.asarray(kmers, dtype=np.uint64)
+    for shift, mask in ((2, 0x3333333333333333), (4, 0x0F0F0F0F0F0F0F0F), (8, 0x00FF00FF00FF00FF),
+                        (16, 0x0000FFFF0000FFFF)):
+        shift, mask = np.uint64(shift), np.uint64(mask)
+        x = ((x >> shift) & mask) | ((x & mask) << shift)
+    x = (x >> np.uint64(32)) | (x << np.uint64(32))
+    return x >> np.uint64(64 - 2 * k)
+
+
+def canonical_kmers(kmers, k):
+    """
+        Canonical form of 2-bit packed k-mers: the smaller of each k-mer and its reverse complement, so a k-mer and its
+        reverse complement get the same code. Returns (canonical, flipped), where flipped is True where the reverse
+        complement was taken.
+    """
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    rc = reverse_complement_kmers(kmers, k)
+    flipped = rc < kmers
+    return np.where(flipped, rc, kmers), flipped
@@ -14,22 +14,31 @@ Created on Wed Nov 10 17:05:03 2021
 @author: Alex
 """
 
-import copy as cp
+import json
+import os
+import shutil
 import numpy as np
-import math
 
-def rotations(t):
-    ''' Return list of rotations of input string t '''
-    tt = t * 2
-    return [ tt[i:i+len(t)] for i in range(0, len(t)) ]
+from data_utils.data_utils import sequence_checksum
 
-def bwm(t):
-    ''' Return lexicographically sorted list of t’s rotations '''
-    return sorted(rotations(t))
+ALPHABET = "$ACGTN#"
+CODES = {c: i for i, c in enumerate(ALPHABET)}
+SEPARATOR = "#"
 
-def bwtViaBwm(t):
-    ''' Given T, returns BWT(T) by way of the BWM '''
-    return ''.join(map(lambda x: x[-1], bwm(t)))
+
+def encode_text(t):
+    ''' Encode string t as a uint8 numpy array of ALPHABET codes. Any character
+        outside the alphabet (e.g. IUPAC ambiguity codes) becomes N. '''
+    table = np.full(256, CODES["N"], dtype=np.uint8)
+    for c, code in CODES.items():
+        table[ord(c)] = code
+        table[ord(c.lower())] = code
+    return table[np.frombuffer(t.encode("ascii"), dtype=np.uint8)]
+
+
+def with_sentinel(t):
+    ''' Append the '$' terminator to t unless it is already there '''
+    return t if t.endswith("$") else t + "$"
 
 
 def rankBwt(bw):
@@ -76,372 +85,956 @@ def reverseBwt(bw):
 
 #########################################
 # Suffix array functions
-# https://louisabraham.github.io/notebooks/suffix_arrays.html
 
-from itertools import zip_longest, islice
-
-def to_int_keys_best(l):
+def suffix_array(codes, sigma=None):
+    """
+    Suffix array of an integer-encoded text that ends with a unique, smallest
+    symbol (the '$' sentinel, code 0).
+
+    Prefix doubling on numpy arrays: suffixes are first bucketed by their
+    leading w symbols packed into one int64 key, then only the suffixes in
+    still-tied buckets are re-sorted by (rank[i], rank[i + h]) while h doubles.
+    DNA has few long repeats, so most suffixes are resolved in the first pass
+    and the later rounds touch only the repeat copies.
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    idx_type = np.int32 if n < 2**31 else np.int64
+    if n == 0:
+        return np.zeros(0, dtype=idx_type)
+    if sigma is None:
+        sigma = int(codes.max()) + 1
+    bits = max(1, int(sigma - 1).bit_length())
+    w = min(63 // bits, n)
+
+    # Initial key: the first w symbols of each suffix, padded with 0 past the end
+    key = np.zeros(n, dtype=np.int64)
+    c64 = codes.astype(np.int64)
+    for j in range(w):
+        key[:n - j] |= c64[j:] << (bits * (w - 1 - j))
+    del c64
+
+    sa = np.argsort(key, kind="stable").astype(idx_type)
+    key = key[sa]
+    new_group = np.empty(n, dtype=bool)
+    new_group[0] = True
+    np.not_equal(key[1:], key[:-1], out=new_group[1:])
+    del key
+
+    # rank[i] = position in sa of the first suffix of i's bucket
+    positions = np.arange(n, dtype=idx_type)
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    rank = np.empty(n, dtype=idx_type)
+    rank[sa] = group_start
+
+    h = w
+    while True:
+        # Rows whose bucket holds more than one suffix still need sorting
+        group_end = np.empty(n, dtype=bool)
+        group_end[-1] = True
+        group_end[:-1] = new_group[1:]
+        unresolved = ~(new_group & group_end)
+        if not unresolved.any():
+            break
+        rows = np.flatnonzero(unresolved)
+        suffixes = sa[rows]
+        # A tied suffix cannot contain the unique sentinel in its first h
+        # symbols, so suffixes + h is always in range.
+        second = rank[suffixes + h]
+        first = group_start[rows]
+        order = np.lexsort((second, first))
+        suffixes = suffixes[order]
+        second = second[order]
+        sa[rows] = suffixes
+
+        split = np.empty(len(rows), dtype=bool)
+        split[0] = True
+        split[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        new_group[rows] = split
+        group_start[rows] = np.maximum.accumulate(np.where(split, rows, 0))
+        rank[suffixes] = group_start[rows]
+        h *= 2
+    return sa
+
+
+class SampledSA:
     """
-    l: iterable of keys
-    returns: a list with integer keys
+    Suffix array sampled at every text position divisible by factor. A
+    BitVector over BWM rows marks the sampled rows and the samples are stored
+    in row order, so a row's sample is values[rank1(row)]. Any row reaches a
+    sampled one within factor - 1 LF steps. Supports `row in sa` and `sa[row]`
+    like the dict it replaces.
     """
-    seen = set()
-    ls = []
-    #print(len(l))
-    for k in range(0,len(l)):
 
-        e = l[k]
-        if not e in seen:
-            ls.append(e)
-            seen.add(e)
-    ls.sort()
-    index = {v: i for i, v in enumerate(ls)}
-    return [index[l[j]] for j in range(0,len(l))]
+    def __init__(self, marked, values, factor):
+        self.marked = marked
+        self.values = values
+        self.factor = factor
 
+    def __contains__(self, row):
+        return bool(self.marked[row])
 
-def suffix_array_inverse(s):
-    """
-    suffix array of s
-    O(n * log(n)^2)
-    """
-    n = len(s)
-    k = 1
-    line = to_int_keys_best(s)
-    while max(line) < n - 1:
-        line = to_int_keys_best(
-            [a * (n + 1) + b + 1
-             for (a, b) in
-             zip_longest(line, islice(line, k, None),
-                         fillvalue=-1)])
-        k <<= 1
-    return line
-
-def final_sa(l):
-    """
-    Inverses sa from above
-    """
-    n = len(l)
-    ans = [0] * n
-    for i in range(n):
-        ans[l[i]] = i
-    return ans
+    def __getitem__(self, row):
+        return int(self.values[self.marked.rank1(row)])
+
+    def __len__(self):
+        return len(self.values)
 
 
-def final_sa1(l,factor):
+def final_sa1(sa,factor):
     """
-    Inverses sa from above
+    Sampled suffix array: keeps the rows whose text offset is a multiple of factor
     """
-    n = len(l)
-    ans = [0] * n
-    for i in range(n):
-        ans[l[i]] = i
-    dic = {}
-    for i in range(len(ans)):
-        if i % factor == 0:
-            dic[i] = ans[i]
-    return dic
+    flags = sa % factor == 0
+    dtype = np.uint32 if len(sa) < 2**32 else np.uint64
+    return SampledSA(BitVector(flags), sa[flags].astype(dtype), factor)
 
 
 
 ######################################
 #Functions I wrote
 
-def totsBWT(bw):
-    '''Map of characters to number of times it appears '''
-    tots = dict()
-    for c in bw:
-        if c not in tots:
-            tots[c] = 0
-        tots[c] += 1
-    return tots
-
-
-
-def firstColMod(tots):
-    ''' Return map from character to the range of rows prefixed by
-        the character. I changed the function to 1-indexed vs
-        0-indexed before'''
-    first = {}
-    totc = 1
-    for c, count in sorted(tots.items()):
-        first[c] = (totc, totc + count)
-        totc += count
-    return first
-
-
-def modifiedRankBWT(bw,step):
-    '''Function that applies the ranking heuristics number 1 and 2 from class'''
-    tots = totsBWT(bw)
-    f = firstColMod(tots)
-    tots = dict()
-    total = 0
-
-    for i in f:
-        f[i] = []
-    f1 = cp.deepcopy(f)
-    f2 = cp.deepcopy(f)
-
-    first = True
-    for i in range(0,len(bw)):
-        c = bw[i]
-        if bw[i] not in tots:
-            tots[c] = 0
-
-        total += 1
-        tots[c] += 1
-        f1[c].append([total, tots[c]])
-
-
-        for j in f1:
-            if j != c:
-
-                if len(f1[j]) == 0:
-                    if first == False:
-                        last_entry_from_main_table = cp.deepcopy(f[j][-1])
-                        last_entry_from_main_table[0] +=1
-                        f1[j].append(last_entry_from_main_table)
-                    else:
-
-                       f1[j].append([1,0])
-                else:
-                    previous_entry =  cp.deepcopy(f1[j][-1])
-                    previous_entry[0] +=1
-                    f1[j].append(previous_entry)
-        first = False
-        if i % step == 0:
-            for k in f:
-                f[k].append(f1[k][-1])
-            f1 = cp.deepcopy(f2)
-    for i in f:
-        f[i] = np.asarray(f[i])
-
-    return f
-
-
-
-
-
-
-
-def find_nearest(array,value):
-    '''Helper function ot find nearest value in the ranking data structure'''
-    idx = np.searchsorted(array[:,0], value, side="left")
-
-    if idx > 0 and (idx == len(array[:,0]) or math.fabs(value - array[:,0][idx-1]) < math.fabs(value - array[:,0][idx])):
-        return array[idx-1]
-    else:
-        return array[idx]
-
-
-
-
-def queryBWT(pattern, index_table, bw):
-    '''Function to return the FM left column indices of where the pattern occurs '''
-    # Get the last char of the pattern
-    """ Reverse the order of the string for ease"""
-    reverse_pattern = pattern[::-1]
-    length = len(reverse_pattern)
-
-    start = 0
-    """ Start with the 1st char of theis string"""
-    starting_char = reverse_pattern[start]
-
-    tots = totsBWT(bw)
-    f = firstColMod(tots)
-    """ Get the first range of characters from the first column"""
-    first_range = f[starting_char]
-
-    final_rank = 0
-
-    next_range = range(first_range[0], first_range[1])
-    next_range1 = []
-
-    for k in range(1, len(pattern)):
-        start += 1
-        """ If there is a next character in the reverse_pattern"""
-        if start < length:
-            """ Go through the range of characters in the first column"""
-            for j in range(len(next_range)):
-                # bw is 0-indexed so have to subtract 1
-                """ Goet the next character"""
-                c = reverse_pattern[start]
-
-                i = next_range[j]
-
-
-                """ Compare the next character with a character at the same index
-                from BWT. Have to subtract 1 because BWT is 0-indexed."""
-                if bw[i-1] == c:
+def firstColumn(counts):
+    ''' C array built from per-symbol counts: rows C[c] to C[c + 1] of the
+        BWM are the ones prefixed by symbol code c. '''
+    C = np.zeros(len(counts) + 1, dtype=np.int64)
+    C[1:] = np.cumsum(counts)
+    return C
+
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def popcount64(words):
+    '''Number of set bits in each uint64 of words'''
+    words = np.asarray(words, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).astype(np.int64)
+    flat = np.ascontiguousarray(words).reshape(-1)
+    counts = _POPCOUNT8[flat.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+    return counts.reshape(words.shape)
+
+
+def low_bits_mask(r):
+    '''uint64 words with the lowest r bits set (r is clipped to [0, 64])'''
+    r = np.asarray(r, dtype=np.int64)
+    shift = np.clip(r, 0, 63).astype(np.uint64)
+    mask = (np.uint64(1) << shift) - np.uint64(1)
+    return np.where(r >= 64, _ALL_ONES, np.where(r <= 0, np.uint64(0), mask))
+
+
+class BitVector:
+    '''
+    Bitvector packed into uint64 words with uint32 counts of set bits before
+    every `step`-th position, for rank1(i) (set bits in [0, i)) in a
+    checkpoint read plus at most step / 64 popcounts. Indexing and rank1
+    accept numpy arrays.
+    '''
+
+    def __init__(self, flags, step=256):
+        assert step % 64 == 0, "step must be a multiple of 64"
+        flags = np.asarray(flags, dtype=bool)
+        self.n = len(flags)
+        self.step = step
+        self.words_per_block = step // 64
+
+        # One spare block so that rank1(n) never reads past the end
+        n_blocks = self.n // step + 2
+        packed = np.packbits(flags, bitorder="little")
+        packed = np.pad(packed, (0, n_blocks * step // 8 - len(packed)))
+        self.words = packed.view("<u8")
+        block_counts = popcount64(self.words).reshape(n_blocks, self.words_per_block).sum(axis=1)
+        self.occ = np.zeros(n_blocks, dtype=np.uint32)
+        self.occ[1:] = np.cumsum(block_counts[:-1])
+
+    @classmethod
+    def from_arrays(cls, n, step, words, occ):
+        '''Rebuild a bitvector from saved (possibly memory-mapped) arrays'''
+        bv = cls.__new__(cls)
+        bv.n = n
+        bv.step = step
+        bv.words_per_block = step // 64
+        bv.words = words
+        bv.occ = occ
+        return bv
+
+    def arrays(self):
+        '''The arrays that make up this bitvector, by name'''
+        return {"words": self.words, "occ": self.occ}
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if np.isscalar(i):
+            i = int(i)
+            return (int(self.words[i >> 6]) >> (i & 63)) & 1
+        i = np.asarray(i, dtype=np.int64)
+        bit = (self.words[i >> 6] >> (i & 63).astype(np.uint64)) & np.uint64(1)
+        return bit.astype(bool)
+
+    def rank1(self, i):
+        '''Number of set bits in [0, i)'''
+        if np.isscalar(i):
+            i = int(i)
+            block = i // self.step
+            total = int(self.occ[block])
+            word = block * self.words_per_block
+            while word * 64 < i:
+                r = min(i - word * 64, 64)
+                total += bin(int(self.words[word]) & ((1 << r) - 1)).count("1")
+                word += 1
+            return total
+        i = np.asarray(i, dtype=np.int64)
+        block = i // self.step
+        total = self.occ[block].astype(np.int64)
+        first_word = block * self.words_per_block
+        for j in range(self.words_per_block):
+            word = first_word + j
+            total += popcount64(self.words[word] & low_bits_mask(i - word * 64))
+        return total
+
+
+class RankTable:
+    '''
+    Occurrence counts over a BWT for constant-time rank queries.
+
+    Every symbol gets a bitvector marking where it occurs in the BWT, packed
+    into uint64 words, plus a uint32 count of its occurrences before every
+    `step`-th position. rank(c, i) reads one checkpoint and popcounts the
+    (at most step / 64) words between the checkpoint and i. Both arguments
+    may be numpy arrays, so a whole batch of ranks is a handful of array ops.
+    '''
+
+    def __init__(self, bwt, sigma, step=64):
+        assert step % 64 == 0, "step must be a multiple of 64"
+        bwt = np.asarray(bwt, dtype=np.uint8)
+        self.n = len(bwt)
+        self.sigma = sigma
+        self.step = step
+        self.words_per_block = step // 64
+
+        # One spare block so that rank(c, n) never reads past the end
+        n_blocks = self.n // step + 2
+        n_words = n_blocks * self.words_per_block
+        self.bits = np.zeros((sigma, n_words), dtype=np.uint64)
+        for c in range(sigma):
+            packed = np.packbits(bwt == c, bitorder="little")
+            packed = np.pad(packed, (0, n_words * 8 - len(packed)))
+            self.bits[c] = packed.view("<u8")
+
+        block_counts = popcount64(self.bits).reshape(sigma, n_blocks, self.words_per_block).sum(axis=2)
+        self.occ = np.zeros((n_blocks, sigma), dtype=np.uint32)
+        self.occ[1:] = np.cumsum(block_counts[:, :-1], axis=1).T
+
+    @classmethod
+    def from_arrays(cls, n, step, occ, bits):
+        '''Rebuild a rank table from saved (possibly memory-mapped) arrays'''
+        table = cls.__new__(cls)
+        table.n = n
+        table.sigma = bits.shape[0]
+        table.step = step
+        table.words_per_block = step // 64
+        table.occ = occ
+        table.bits = bits
+        return table
+
+    def rank(self, c, i):
+        '''Number of occurrences of symbol code c in bwt[0:i]'''
+        if np.isscalar(c) and np.isscalar(i):
+            return self._rank_scalar(int(c), int(i))
+        c = np.asarray(c, dtype=np.int64)
+        i = np.asarray(i, dtype=np.int64)
+        block = i // self.step
+        total = self.occ[block, c].astype(np.int64)
+        first_word = block * self.words_per_block
+        for j in range(self.words_per_block):
+            word = first_word + j
+            mask = low_bits_mask(i - word * 64)
+            total += popcount64(self.bits[c, word] & mask)
+        return total
+
+    def _rank_scalar(self, c, i):
+        '''rank() for a single (c, i) pair using Python ints, which avoids the
+        per-call overhead of numpy on 0-d arrays'''
+        block = i // self.step
+        total = int(self.occ[block, c])
+        word = block * self.words_per_block
+        bits = self.bits[c]
+        while (word + 1) * 64 <= i:
+            total += bin(int(bits[word])).count("1")
+            word += 1
+        r = i - word * 64
+        if r > 0:
+            total += bin(int(bits[word]) & ((1 << r) - 1)).count("1")
+        return total
+
+
+
+
+
+_LOW_BITS = np.uint64(0x5555555555555555)
+_REPEATED_2BIT = np.array([x * 0x5555555555555555 for x in range(4)], dtype=np.uint64)
+
+
+class PackedBWT:
+    '''
+    BWT stored at 2 bits per base, for low-memory FM indexes.
+
+    A, C, G and T are packed 32 to a uint64 word. The few other symbols ($,
+    # separators, N) are written as A in the words and listed separately as
+    sorted exception positions. Checkpoints every `step` positions hold the
+    raw counts of the four 2-bit codes, and rank(c, i) popcounts the codes
+    equal to c in the (at most step / 32) words past the checkpoint, with an
+    XOR against c repeated in every slot. Exceptions are subtracted from the
+    A count and ranked on their own with a binary search. The object is both
+    the BWT and its rank table: it supports len(), indexing and rank().
+    '''
+
+    def __init__(self, bwt, step=128):
+        assert step % 32 == 0, "step must be a multiple of 32"
+        bwt = np.asarray(bwt, dtype=np.uint8)
+        self.n = len(bwt)
+        self.step = step
+        self.words_per_block = step // 32
+
+        is_base = (bwt >= CODES["A"]) & (bwt <= CODES["T"])
+        exc_pos = np.flatnonzero(~is_base)
+        values = np.where(is_base, bwt - CODES["A"], 0).astype(np.uint64)
+
+        # One spare block so that rank(c, n) never reads past the end
+        n_blocks = self.n // step + 2
+        values = np.pad(values, (0, n_blocks * step - self.n))
+        shifts = (2 * np.arange(32)).astype(np.uint64)
+        words = (values.reshape(-1, 32) << shifts).sum(axis=1, dtype=np.uint64)
+
+        block_counts = np.stack([(values == x).reshape(n_blocks, step).sum(axis=1) for x in range(4)], axis=1)
+        occ = np.zeros((n_blocks, 4), dtype=np.uint32)
+        occ[1:] = np.cumsum(block_counts[:-1], axis=0)
+        self._set_arrays(words, occ, exc_pos.astype(np.int64), bwt[exc_pos])
+
+    @classmethod
+    def from_arrays(cls, n, step, words, occ, exc_pos, exc_sym):
+        '''Rebuild a packed BWT from saved (possibly memory-mapped) arrays'''
+        packed = cls.__new__(cls)
+        packed.n = n
+        packed.step = step
+        packed.words_per_block = step // 32
+        packed._set_arrays(words, occ, exc_pos, exc_sym)
+        return packed
+
+    def _set_arrays(self, words, occ, exc_pos, exc_sym):
+        self.words = words
+        self.occ = occ
+        self.exc_pos = exc_pos
+        self.exc_sym = exc_sym
+        self._exc_by_sym = {s: np.asarray(exc_pos[exc_sym == s]) for s in np.unique(exc_sym).tolist()}
+
+    def arrays(self):
+        '''The arrays that make up this BWT, by name'''
+        return {"words": self.words, "occ": self.occ, "exc_pos": self.exc_pos, "exc_sym": self.exc_sym}
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, row):
+        '''Symbol code(s) at BWT position(s) row'''
+        if np.isscalar(row):
+            row = int(row)
+            e = int(np.searchsorted(self.exc_pos, row))
+            if e < len(self.exc_pos) and self.exc_pos[e] == row:
+                return int(self.exc_sym[e])
+            return ((int(self.words[row >> 5]) >> (2 * (row & 31))) & 3) + CODES["A"]
+        row = np.asarray(row, dtype=np.int64)
+        shift = (2 * (row & 31)).astype(np.uint64)
+        sym = ((self.words[row >> 5] >> shift) & np.uint64(3)).astype(np.uint8) + CODES["A"]
+        e = np.searchsorted(self.exc_pos, row)
+        hit = e < len(self.exc_pos)
+        hit[hit] = self.exc_pos[e[hit]] == row[hit]
+        sym[hit] = self.exc_sym[e[hit]]
+        return sym
+
+    def rank(self, c, i):
+        '''Number of occurrences of symbol code c in bwt[0:i]'''
+        if np.isscalar(c) and np.isscalar(i):
+            return self._rank_scalar(int(c), int(i))
+        c, i = np.broadcast_arrays(np.asarray(c, dtype=np.int64), np.asarray(i, dtype=np.int64))
+        result = np.zeros(c.shape, dtype=np.int64)
+
+        is_base = (c >= CODES["A"]) & (c <= CODES["T"])
+        x = c[is_base] - CODES["A"]
+        pos = i[is_base]
+        block = pos // self.step
+        total = self.occ[block, x].astype(np.int64)
+        first_word = block * self.words_per_block
+        pattern = _REPEATED_2BIT[x]
+        for j in range(self.words_per_block):
+            word = first_word + j
+            y = self.words[word] ^ pattern
+            matches = ~(y | (y >> np.uint64(1))) & _LOW_BITS
+            total += popcount64(matches & low_bits_mask(2 * (pos - word * 32)))
+        is_a = x == 0
+        total[is_a] -= np.searchsorted(self.exc_pos, pos[is_a])
+        result[is_base] = total
+
+        for s, positions in self._exc_by_sym.items():
+            sel = c == s
+            result[sel] = np.searchsorted(positions, i[sel])
+        return result
+
+    def _rank_scalar(self, c, i):
+        '''rank() for a single (c, i) pair using Python ints'''
+        if not CODES["A"] <= c <= CODES["T"]:
+            positions = self._exc_by_sym.get(c)
+            return 0 if positions is None else int(np.searchsorted(positions, i))
+        x = c - CODES["A"]
+        pattern = int(_REPEATED_2BIT[x])
+        block = i // self.step
+        total = int(self.occ[block, x])
+        word = block * self.words_per_block
+        while word * 32 < i:
+            y = int(self.words[word]) ^ pattern
+            matches = ~(y | (y >> 1)) & 0x5555555555555555
+            r = min(i - word * 32, 32)
+            total += bin(matches & ((1 << (2 * r)) - 1)).count("1")
+            word += 1
+        if x == 0:
+            total -= int(np.searchsorted(self.exc_pos, i))
+        return total
+
+
+def backward_search(fm, pattern):
+    '''Return the [sp, ep) range of BWM rows prefixed by pattern. Each
+    character costs two rank lookups, however many occurrences there are.'''
+    b, m, C = fm[0], fm[1], fm[2]
+    sp, ep = 0, len(b)
+    for c in encode_text(pattern)[::-1]:
+        sp = int(C[c]) + m.rank(c, sp)
+        ep = int(C[c]) + m.rank(c, ep)
+        if sp >= ep:
+            return sp, sp
+    return sp, ep
+
+
+def count_in_template(fm, pattern):
+    '''Number of exact occurrences of pattern, without locating them'''
+    sp, ep = backward_search(fm, pattern)
+    return ep - sp
+
+
+PAD = 255
+
+
+def encode_reads(seqs):
+    '''Stack read sequences into a 2D uint8 matrix of ALPHABET codes, one
+    read per row. Shorter reads are right-aligned and padded on the left with
+    PAD, so column -1 always holds the last base that backward search needs.'''
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    width = int(lengths.max()) if len(seqs) else 0
+    if len(seqs) and (lengths == width).all():
+        return encode_text("".join(seqs)).reshape(len(seqs), width)
+    reads = np.full((len(seqs), width), PAD, dtype=np.uint8)
+    for r, s in enumerate(seqs):
+        if len(s):
+            reads[r, width - len(s):] = encode_text(s)
+    return reads
+
+
+def backward_search_batch(fm, reads):
+    '''Backward search for every row of a read matrix (see encode_reads) at
+    once. All intervals advance one column per step with vectorized rank
+    lookups, and reads whose interval empties are dropped from the working
+    set. Returns the final sp and ep arrays; sp == ep means no match.'''
+    b, m, C = fm[0], fm[1], fm[2]
+    n_reads = reads.shape[0]
+    sp = np.zeros(n_reads, dtype=np.int64)
+    ep = np.zeros(n_reads, dtype=np.int64)
+
+    alive = np.arange(n_reads)
+    cur_sp = np.zeros(n_reads, dtype=np.int64)
+    cur_ep = np.full(n_reads, len(b), dtype=np.int64)
+    for col in range(reads.shape[1] - 1, -1, -1):
+        c = reads[alive, col]
+        step = c != PAD
+        cs = c[step].astype(np.int64)
+        cur_sp[step] = C[cs] + m.rank(cs, cur_sp[step])
+        cur_ep[step] = C[cs] + m.rank(cs, cur_ep[step])
+
+        keep = cur_sp < cur_ep
+        if not keep.all():
+            alive, cur_sp, cur_ep = alive[keep], cur_sp[keep], cur_ep[keep]
+            if len(alive) == 0:
+                break
+
+    sp[alive] = cur_sp
+    ep[alive] = cur_ep
+    return sp, ep
+
+
+def count_batch(fm, reads):
+    '''Number of exact occurrences of every read in a read matrix'''
+    sp, ep = backward_search_batch(fm, reads)
+    return ep - sp
 
 
-                    """In the dictonary go to the 'column' of the desired
-                    character and find the nearest available total index"""
-                    closest_index = find_nearest(index_table[c], i)
-                    """If the nearest available total index is the actual total
-                    index then we can return the corresponding char-specific index.
-                    That will be the actual index of the character."""
-                    if closest_index[0] == i:
-                        final_rank = closest_index[1]
-                        #print(final_rank)
-                    """If the nearest available total index is smaller than
-                    the actual total index, we have to walk down bwt"""
-
-                    if closest_index[0] < i:
-                        # Subtract 1 because bw is 0-indexed
-                        closest_in_bw = closest_index[0]
-                        final_rank = closest_index[1]
-                        for j in range(closest_in_bw, i):
-                            if bw[j] == c:
-                                final_rank += 1
-                    if closest_index[0] > i:
-                        # Subtract 1 because bw is 0-indexed
-                        closest_in_bw = closest_index[0]
-                        final_rank = closest_index[1]
-                        for j in range(i, closest_in_bw):
-                            if bw[j] == c:
-                                final_rank -= 1
-
-                    """After we have found the index of the character, need to
-                    find where it is in the left column"""
-
-                    transition_index = f[c][0] + final_rank -1
-                    next_range1.append(transition_index)
-
-            next_range = cp.deepcopy(next_range1)
-            next_range1 = []
-
-
-
-    return next_range
+#########################################
+# Mismatch-tolerant search
+# Substitution-only backtracking in the style of BWA's bounded search. The
+# reverse index gives, for every prefix of a read, a lower bound D on how many
+# mismatches that prefix needs; a partial alignment is abandoned as soon as
+# its mismatches so far plus D of the unread prefix exceed k. All alignments
+# of a batch consume one read column per step, so the whole frontier advances
+# with a few vectorized rank lookups.
+
+BASES = np.array([CODES[c] for c in "ACGT"], dtype=np.int64)
+
+
+def construct_reverse_fm(template, compact=False):
+    '''FM index of the reversed template, used only for mismatch lower bounds,
+    so it keeps a single SA sample'''
+    return construct_fm(template[::-1], len(template) + 1, compact)
+
+
+def mismatch_bounds(rev_fm, reads):
+    '''D array for every read in a read matrix: D[r, col] is a lower bound on
+    the mismatches needed to place the prefix of read r ending at col. Scanning
+    left to right with the reverse index, each time the prefix stops occurring
+    one more mismatch is unavoidable and the search restarts after it.'''
+    b, m, C = rev_fm[0], rev_fm[1], rev_fm[2]
+    n_reads, width = reads.shape
+    D = np.zeros((n_reads, width), dtype=np.int16)
+    z = np.zeros(n_reads, dtype=np.int16)
+    sp = np.zeros(n_reads, dtype=np.int64)
+    ep = np.full(n_reads, len(b), dtype=np.int64)
+    for col in range(width):
+        c = reads[:, col]
+        step = c != PAD
+        cs = c[step].astype(np.int64)
+        sp[step] = C[cs] + m.rank(cs, sp[step])
+        ep[step] = C[cs] + m.rank(cs, ep[step])
+        empty = step & (sp >= ep)
+        z[empty] += 1
+        sp[empty] = 0
+        ep[empty] = len(b)
+        D[:, col] = z
+    return D
+
+
+def backtrack_batch(fm, reads, D, k):
+    '''All BWM intervals matching some read of the matrix with at most k
+    substitutions. Returns parallel arrays (read index, sp, ep); intervals of
+    different alignments of the same read never overlap.'''
+    b, m, C = fm[0], fm[1], fm[2]
+    n_reads, width = reads.shape
+    rid = np.arange(n_reads)
+    sp = np.zeros(n_reads, dtype=np.int64)
+    ep = np.full(n_reads, len(b), dtype=np.int64)
+    z = np.zeros(n_reads, dtype=np.int16)
+
+    for col in range(width - 1, -1, -1):
+        c = reads[rid, col].astype(np.int64)
+        pad = c == PAD
+
+        # Follow the read base, and every other base while mismatches remain
+        # (an N in the read is a mismatch against all four bases)
+        branch = ~pad & (z < k)
+        sub_rid = np.repeat(rid[branch], 4)
+        sub_c = np.tile(BASES, int(branch.sum()))
+        keep_sub = sub_c != np.repeat(c[branch], 4)
+        follow = ~pad & (c != CODES["N"])
+        new_rid = np.concatenate((rid[pad], rid[follow], sub_rid[keep_sub]))
+        new_c = np.concatenate((c[pad], c[follow], sub_c[keep_sub]))
+        new_z = np.concatenate((z[pad], z[follow], np.repeat(z[branch] + 1, 4)[keep_sub]))
+        parent = np.concatenate((np.flatnonzero(pad), np.flatnonzero(follow),
+                                 np.repeat(np.flatnonzero(branch), 4)[keep_sub]))
+        new_sp, new_ep = sp[parent], ep[parent]
+
+        moved = len(rid[pad])
+        cs = new_c[moved:]
+        new_sp[moved:] = C[cs] + m.rank(cs, new_sp[moved:])
+        new_ep[moved:] = C[cs] + m.rank(cs, new_ep[moved:])
+
+        bound = new_z
+        if col > 0:
+            bound = new_z + D[new_rid, col - 1]
+        keep = (new_sp < new_ep) & (bound <= k)
+        rid, sp, ep, z = new_rid[keep], new_sp[keep], new_ep[keep], new_z[keep]
+        if len(rid) == 0:
+            break
+
+    return rid, sp, ep
+
+
+def count_mismatch_batch(fm, rev_fm, reads, k, chunk_size=10000):
+    '''Number of occurrences of every read in a read matrix with at most k
+    substitutions. Reads are searched in chunks to bound the frontier size.'''
+    counts = np.zeros(reads.shape[0], dtype=np.int64)
+    for start in range(0, reads.shape[0], chunk_size):
+        chunk = reads[start:start + chunk_size]
+        rid, sp, ep = backtrack_batch(fm, chunk, mismatch_bounds(rev_fm, chunk), k)
+        counts[start:start + len(chunk)] = np.bincount(rid, weights=ep - sp, minlength=len(chunk))
+    return counts
 
 
 def locate_in_template(template, pattern):
     '''Function to query the pattern in the template with SA with no gaps'''
-    b = bwtViaBwm(template)
-    m = modifiedRankBWT(b,3)
-    ranks = queryBWT(pattern, m, b)
-    actual_indexes = []
-    sa = final_sa(suffix_array_inverse(template))
-    for i in range(len(ranks)):
-        actual_indexes.append(sa[ranks[i]-1])
-    return actual_indexes
-
-
-
+    fm = construct_fm(template, 1)
+    sa = fm[3]
+    sp, ep = backward_search(fm, pattern)
+    return [sa[row] for row in range(sp, ep)]
 
-def construct_fm(template, factor):
-    b = bwtViaBwm(template)
-    m = modifiedRankBWT(b,factor)
 
 
-    sa = final_sa1(suffix_array_inverse(template),factor)
-    tots = totsBWT(b)
-    f = firstColMod(tots)
-    return [b, m,f, sa]
 
+def fm_from_codes(codes, factor, compact=False):
+    '''Build [BWT, rank table, C array, sampled SA] from an encoded,
+    $-terminated text. Also returns the full suffix array it came from.
+    With compact=True the BWT is a PackedBWT, which is its own rank table.'''
+    full_sa = suffix_array(codes, len(ALPHABET))
+    b = codes[full_sa - 1]
+    if compact:
+        b = m = PackedBWT(b)
+    else:
+        m = RankTable(b, len(ALPHABET))
+
+    sa = final_sa1(full_sa,factor)
+    C = firstColumn(np.bincount(codes, minlength=len(ALPHABET)))
+    return [b, m, C, sa], full_sa
+
+
+def construct_fm(template, factor, compact=False):
+    '''Build [BWT, rank table, C array, sampled SA] for template.
+    Everything is derived from one suffix array of the $-terminated text.'''
+    fm, _ = fm_from_codes(encode_text(with_sentinel(template)), factor, compact)
+    return fm
+
+
+def construct_panel_fm(templates, ref_ids, desired, factor, compact=False):
+    '''Build one FM index over every reference fragment, joined by SEPARATOR.
+    Returns [fm, starts, ref_ids, desired, desired_rows]:
+        starts - sorted text offset of each fragment, to map hits to references
+        desired - per fragment, True for desired and False for contaminant
+        desired_rows - bitvector over BWM rows flagging rows whose suffix
+                       starts in a desired fragment, so the desired hits of
+                       any [sp, ep) interval are counted without locating them
+    '''
+    lengths = np.array([len(t) for t in templates], dtype=np.int64)
+    starts = np.zeros(len(templates), dtype=np.int64)
+    starts[1:] = np.cumsum(lengths + 1)[:-1]
+    desired = np.asarray(desired, dtype=bool)
+
+    codes = encode_text(SEPARATOR.join(templates) + "$")
+    fm, full_sa = fm_from_codes(codes, factor, compact)
+    row_refs = np.searchsorted(starts, full_sa, side="right") - 1
+    desired_rows = BitVector(desired[row_refs])
+    return [fm, starts, list(ref_ids), desired, desired_rows]
+
+
+def panel_hits_batch(panel, reads, k=0, rev_fm=None, chunk_size=10000):
+    '''Hits of every read in a read matrix against a panel index, split into
+    (desired hits, contaminant hits). With k > 0, hits with up to k
+    substitutions are counted, which needs the reverse panel index rev_fm.'''
+    fm, desired_rows = panel[0], panel[4]
+    if k == 0:
+        sp, ep = backward_search_batch(fm, reads)
+        des_hits = desired_rows.rank1(ep) - desired_rows.rank1(sp)
+        return des_hits, (ep - sp) - des_hits
+
+    des_hits = np.zeros(reads.shape[0], dtype=np.int64)
+    all_hits = np.zeros(reads.shape[0], dtype=np.int64)
+    for start in range(0, reads.shape[0], chunk_size):
+        chunk = reads[start:start + chunk_size]
+        rid, sp, ep = backtrack_batch(fm, chunk, mismatch_bounds(rev_fm, chunk), k)
+        des = desired_rows.rank1(ep) - desired_rows.rank1(sp)
+        des_hits[start:start + len(chunk)] = np.bincount(rid, weights=des, minlength=len(chunk))
+        all_hits[start:start + len(chunk)] = np.bincount(rid, weights=ep - sp, minlength=len(chunk))
+    return des_hits, all_hits - des_hits
+
+
+def locate_in_panel(panel, pattern):
+    '''Locate pattern in a panel index as (reference id, offset) pairs'''
+    fm, starts, ref_ids = panel[0], panel[1], panel[2]
+    positions = np.array(locate_in_template1(fm, pattern)[0], dtype=np.int64)
+    refs = np.searchsorted(starts, positions, side="right") - 1
+    return [(ref_ids[r], int(p - starts[r])) for r, p in zip(refs, positions)]
+
+
+
+def locate_rows(fm, rows):
+    '''Text offsets of an array of BWM rows. All rows walk LF together, one
+    vectorized step at a time, and leave the walk as soon as they reach a
+    sampled row; with text-position sampling that takes at most factor - 1
+    steps.'''
+    b, m, C, sa = fm
+    rows = np.asarray(rows, dtype=np.int64)
+    positions = np.zeros(len(rows), dtype=np.int64)
+    pending = np.arange(len(rows))
+    steps = 0
+    while len(pending):
+        sampled = sa.marked[rows]
+        done = pending[sampled]
+        positions[done] = (sa.values[sa.marked.rank1(rows[sampled])].astype(np.int64) + steps) % len(b)
+        pending, rows = pending[~sampled], rows[~sampled]
+        c = np.asarray(b[rows], dtype=np.int64)
+        rows = C[c] + m.rank(c, rows)
+        steps += 1
+    return positions
 
 
 def locate_in_template1(fm,pattern):
     '''Function to query the pattern in the template with SA with gaps'''
-    """b = bwtViaBwm(template)
-    m = modifiedRankBWT(b,factor)
-    ranks = queryBWT(pattern, m, b)
-
-    sa = final_sa1(suffix_array_inverse(template),factor)
-    tots = totsBWT(b)
-    """
-    b = fm[0]
-    m = fm[1]
-
-    f = fm[2]
-    sa = fm[3]
-
-
-    ranks = queryBWT(pattern, m, b)
-    actual_indexes = []
-
-
-
-    for i in range(len(ranks)):
-
-        if ranks[i]-1 in sa:
-            actual_indexes.append(sa[ranks[i]-1])
-        else:
-            count  = 0
-            transition_index = ranks[i]
-            while transition_index-1 not in sa:
-
-                ch = b[transition_index-1]
-                closest_index = find_nearest(m[ch], transition_index)
-                final_rank = 0
-                if closest_index[0] == transition_index:
-                    final_rank = closest_index[1]
+    sp, ep = backward_search(fm, pattern)
+    actual_indexes = locate_rows(fm, np.arange(sp, ep)).tolist()
 
-                if closest_index[0] < transition_index:
-                           # Subtract 1 because bw is 0-indexed
-                    closest_in_bw = closest_index[0]
-                    final_rank = closest_index[1]
-                    for j in range(closest_in_bw, transition_index):
-                        if b[j] == ch:
-                            final_rank += 1
-                if closest_index[0] > transition_index:
-                           # Subtract 1 because bw is 0-indexed
-                   closest_in_bw = closest_index[0]
-                   final_rank = closest_index[1]
-                   for j in range(transition_index, closest_in_bw):
-                       if b[j] == ch:
-                           final_rank -= 1
+    return [actual_indexes, ep - sp]
 
-                transition_index = f[ch][0] + final_rank -1
-                count +=1
-            actual_indexes.append((sa[transition_index-1]+count)%len(b))
 
-    return [actual_indexes, len(ranks)]
+def locate_batch(fm, reads):
+    '''Locate every exact hit of every read in a read matrix. Returns parallel
+    arrays (read index, text offset).'''
+    sp, ep = backward_search_batch(fm, reads)
+    counts = ep - sp
+    rid = np.repeat(np.arange(len(counts)), counts)
+    # Row of each hit: its interval start plus its index within the interval
+    rows = np.repeat(sp - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return rid, locate_rows(fm, rows)
 
 
+def locate_panel_batch(panel, reads):
+    '''Locate every exact hit of every read in a read matrix against a panel
+    index. Returns parallel arrays (read index, fragment index, offset within
+    the fragment); panel[2][fragment index] is the reference id.'''
+    starts = panel[1]
+    rid, positions = locate_batch(panel[0], reads)
+    refs = np.searchsorted(starts, positions, side="right") - 1
+    return rid, refs, positions - starts[refs]
 
 
-
-def fm_engine(fasta_objects, cont_fasta_objects, fastq_objects, factor=10):
+#########################################
+# On-disk FM indexes
+# Each index is a directory holding one .npy file per array plus a small JSON
+# header. Arrays are loaded with mmap_mode='r', so start-up does no work and
+# concurrent workers share a single copy through the page cache.
+
+CACHE_PATH = "cache/fm/"
+FORMAT_VERSION = 3
+
+
+def save_fm(fm, path, arrays=None, **header):
+    '''Write an FM index to directory path. arrays maps names to any extra
+    arrays to store with the index, and extra keyword arguments are stored in
+    the header. The directory is written under a temporary name and renamed
+    into place so readers never see a half-written index.'''
+    b, m, C, sa = fm
+    tmp = path.rstrip("/") + ".tmp%d" % os.getpid()
+    os.makedirs(tmp, exist_ok=True)
+    if isinstance(m, PackedBWT):
+        all_arrays = m.arrays()
+        header["bwt_format"] = "packed"
+    else:
+        all_arrays = {"bwt": b, "occ": m.occ, "bits": m.bits}
+        header["bwt_format"] = "bytes"
+    all_arrays.update({"C": C, "sa": sa.values, "sa_marked_words": sa.marked.words, "sa_marked_occ": sa.marked.occ})
+    all_arrays.update(arrays or {})
+    for name, arr in all_arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(arr))
+    header.update({
+        "version": FORMAT_VERSION,
+        "alphabet": ALPHABET,
+        "n": int(len(b)),
+        "step": m.step,
+        "factor": sa.factor,
+        "sa_marked_step": sa.marked.step,
+        "arrays": sorted(all_arrays),
+    })
+    with open(os.path.join(tmp, "header.json"), "w") as f:
+        json.dump(header, f)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Another process saved the same index first; keep theirs
+        shutil.rmtree(tmp)
+
+
+def read_fm_header(path):
+    '''Return the header of a saved FM index, or None if there is no usable
+    index at path (including one with array files missing)'''
+    try:
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if header.get("version") != FORMAT_VERSION or header.get("alphabet") != ALPHABET:
+        return None
+    if not all(os.path.isfile(os.path.join(path, name + ".npy")) for name in header.get("arrays", [])):
+        return None
+    return header
+
+
+def load_fm(path):
+    '''Memory-map a saved FM index. Returns [BWT, rank table, C array, sampled SA].'''
+    header = read_fm_header(path)
+    if header is None:
+        raise FileNotFoundError(f"No FM index (format {FORMAT_VERSION}) at '{path}'")
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    if header.get("bwt_format") == "packed":
+        b = m = PackedBWT.from_arrays(header["n"], header["step"], load("words"), load("occ"),
+                                      load("exc_pos"), load("exc_sym"))
+    else:
+        b = load("bwt")
+        m = RankTable.from_arrays(header["n"], header["step"], load("occ"), load("bits"))
+    marked = BitVector.from_arrays(header["n"], header["sa_marked_step"], load("sa_marked_words"), load("sa_marked_occ"))
+    return [b, m, np.array(load("C")), SampledSA(marked, load("sa"), header["factor"])]
+
+
+def save_panel_fm(panel, path):
+    '''Write a panel index (see construct_panel_fm) to directory path'''
+    fm, starts, ref_ids, desired, desired_rows = panel
+    arrays = {"starts": starts, "desired": desired,
+              "desired_words": desired_rows.words, "desired_occ": desired_rows.occ}
+    save_fm(fm, path, arrays, ref_ids=ref_ids, desired_step=desired_rows.step)
+
+
+def load_panel_fm(path):
+    '''Memory-map a panel index written by save_panel_fm'''
+    fm = load_fm(path)
+    header = read_fm_header(path)
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    desired_rows = BitVector.from_arrays(header["n"], header["desired_step"], load("desired_words"), load("desired_occ"))
+    return [fm, np.array(load("starts")), header["ref_ids"], np.array(load("desired")), desired_rows]
+
+
+def fm_cache_key(templates, factor, *extra):
+    '''Checksum identifying an index built from templates with this sampling factor'''
+    return sequence_checksum(templates, FORMAT_VERSION, factor, *extra)[:16]
+
+
+def cached_fm(template, factor, name, cache=True, compact=False):
+    '''Load the FM index of template from the cache, building and saving it
+    first if the cached copy is missing or was built from different data'''
+    path = CACHE_PATH + f"{name}_{fm_cache_key([template], factor, compact)}"
+    if cache and read_fm_header(path) is not None:
+        return load_fm(path)
+    fm = construct_fm(template, factor, compact)
+    if cache:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        save_fm(fm, path)
+    return fm
+
+
+def cached_reverse_fm(templates, name, cache=True, compact=False):
+    '''Cached counterpart of construct_reverse_fm for the templates joined by
+    SEPARATOR. The cache key comes from the templates themselves, so the
+    joined, reversed text is only built when the index has to be built.'''
+    path = CACHE_PATH + f"{name}.rev_{fm_cache_key(templates, 'rev', compact)}"
+    if cache and read_fm_header(path) is not None:
+        return load_fm(path)
+    fm = construct_reverse_fm(SEPARATOR.join(templates), compact)
+    if cache:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        save_fm(fm, path)
+    return fm
+
+
+def cached_panel_fm(templates, ref_ids, desired, factor, cache=True, compact=False):
+    '''Panel counterpart of cached_fm'''
+    path = CACHE_PATH + "panel_" + fm_cache_key(templates, factor, ref_ids, list(desired), compact)
+    if cache and read_fm_header(path) is not None:
+        return load_panel_fm(path)
+    panel = construct_panel_fm(templates, ref_ids, desired, factor, compact)
+    if cache:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        save_panel_fm(panel, path)
+    return panel
+
+
+def fm_engine(fasta_objects, cont_fasta_objects, fastq_objects, factor=10, batch_size=100000, single_index=False, cache=True, mismatches=0, compact=False):
 
     #fasta_objects = read_fasta_files(fastas)
     #cont_fasta_objects = read_fasta_files(cont_fastas)
     #fastq_objects = read_fastq_files(fastqs)
 
     groupings = {"Desired": [], "Contaminated": [], 'Unassigned': []}
-    other = []
-
-    fms = []
-    for fasta in fasta_objects:
-        for i,template in enumerate(fasta):
-
-            fms.append([fasta.ids[i], construct_fm(template, factor)])
 
-    co_fms = []
-    for fasta in cont_fasta_objects:
-        for i,template in enumerate(fasta):
-            co_fms.append([fasta.ids[i], construct_fm(template, factor)])
-
-
-    for fm in fms:
-        for fastq in fastq_objects:
-            for fastq_dict in fastq:
-
-                pattern = fastq_dict['seq']
-                info = locate_in_template1(fm[1],pattern)
-                if info[1]> 0:
+    if single_index:
+        # One index over the whole panel; each read is searched exactly once
+        templates, ref_ids, desired = [], [], []
+        for fasta_list, is_desired in ((fasta_objects, True), (cont_fasta_objects, False)):
+            for fasta in fasta_list:
+                for i,template in enumerate(fasta):
+                    templates.append(template)
+                    ref_ids.append(fasta.ids[i])
+                    desired.append(is_desired)
+        panel = cached_panel_fm(templates, ref_ids, desired, factor, cache, compact)
+        if mismatches > 0:
+            rev_panel = cached_reverse_fm(templates, "panel", cache, compact)
+    else:
+        fms = []
+        for fasta in fasta_objects:
+            filename = fasta.filename.split("/")[-1]
+            for i,template in enumerate(fasta):
+
+                fms.append([fasta.ids[i], cached_fm(template, factor, f"{filename}.{i}", cache, compact)])
+                if mismatches > 0:
+                    fms[-1].append(cached_reverse_fm([template], f"{filename}.{i}", cache, compact))
+
+        co_fms = []
+        for fasta in cont_fasta_objects:
+            filename = fasta.filename.split("/")[-1]
+            for i,template in enumerate(fasta):
+                co_fms.append([fasta.ids[i], cached_fm(template, factor, f"{filename}.{i}", cache, compact)])
+                if mismatches > 0:
+                    co_fms[-1].append(cached_reverse_fm([template], f"{filename}.{i}", cache, compact))
+
+    def hits(reads, k):
+        '''Whether each read occurs with at most k mismatches in some desired
+        fragment, and whether it does in some contaminant fragment'''
+        if single_index:
+            des_hits, cont_hits = panel_hits_batch(panel, reads, k, rev_panel if k else None)
+            return des_hits > 0, cont_hits > 0
+        def found(fm, rows):
+            if k == 0:
+                return count_batch(fm[1], reads[rows]) > 0
+            return count_mismatch_batch(fm[1], fm[2], reads[rows], k) > 0
+
+        in_des = np.zeros(len(reads), dtype=bool)
+        for fm in fms:
+            in_des |= found(fm, slice(None))
+        in_cont = np.zeros(len(reads), dtype=bool)
+        rest = np.flatnonzero(~in_des)
+        for fm in co_fms:
+            in_cont[rest] |= found(fm, rest)
+        return in_des, in_cont
+
+    for fastq in fastq_objects:
+        seqs = fastq.get_read_sequences()
+        for start in range(0, len(seqs), batch_size):
+            reads = encode_reads(seqs[start:start + batch_size])
+
+            # A read is desired if any desired fragment contains it, otherwise
+            # contaminated if any contaminant fragment does. Reads that match
+            # nothing exactly are retried with 1, 2, ... mismatches, so a read
+            # is always assigned at its smallest mismatch count.
+            in_des = np.zeros(len(reads), dtype=bool)
+            in_cont = np.zeros(len(reads), dtype=bool)
+            for k in range(mismatches + 1):
+                todo = np.flatnonzero(~(in_des | in_cont))
+                if len(todo) == 0:
+                    break
+                des, cont = hits(reads[todo], k)
+                in_des[todo] = des
+                in_cont[todo] = cont & ~des
+
+            for r in range(len(reads)):
+                fastq_dict = fastq[start + r]
+                if in_des[r]:
                     groupings["Desired"].append(fastq_dict)
+                elif in_cont[r]:
+                    groupings["Contaminated"].append(fastq_dict)
                 else:
-                    other.append(fastq_dict)
-
-    for fm in co_fms:
-        for fastq_dict in other:
-            pattern = fastq_dict['seq']
-            info = locate_in_template1(fm[1],pattern)
-            if info[1]> 0:
-                groupings["Contaminated"].append(fastq_dict)
-            else:
-                groupings["Unassigned"].append(fastq_dict)
-
+                    groupings["Unassigned"].append(fastq_dict)
 
     return groupings
@@ -1,159 +1,949 @@
-
-
-def build_kmer_index(FA, k):
-    """ Construct a basic kmer index from an input FASTA file and a kmer length. """
-    #make an empty dictionary for the build_kmer_index
-    #keys will be kmers and entries will be a list of where in the fasta the kmer starts
-    idx_list = [] #list to store all the indices created from a multi fastsa file
-    FA_list = [] #list to seperately store the FA's from a multi fasta file
-    for entry in FA:
-        for frag in entry:
-            idx = {}
-            for i in range(len(frag)-k+1):
-                mer = frag[i:i+k]
-                #make new entries for new kmers
-                if mer not in idx:
-                    idx[mer] = [i]
-                #append the location of repeated kmers to the list
-                elif mer in idx:
-                    idx[mer].append(i)
-            idx_list.append(idx)
-            FA_list.append(frag)
-
-    #return the completed kmer index
-    return idx_list, FA_list
-
-def kmer_engine(FQ, des_ref, cont_refs, k = 10, tolerance = 5): #requires the desired reference to be input as a single fasta file, contaminant can be multi fasta
-    #Inputs must be fastq and fasta objects, with integers for k and tolerance
-    """Returns three dictionaries containing which reads allign to the desired reference, a contaminant reference, or neither"""
-
-    #make indexes from desired references
-    otpt = build_kmer_index(des_ref, k)
-    des_idxs = otpt[0]
-    #print(des_idxs)
-    des_FAs = otpt[1]
-
-    #make indexes from contamination references
-    otpt2 = build_kmer_index(cont_refs, k)
-    cont_idxs = otpt2[0]
-    #print(cont_idxs)
-    cont_FA = otpt2[1]
-
-    #set the counts of desired and contaminant reads
-    des_count = 0
-    cont_count = 0
-    unas_count = 0
-
-
-    #start with exact match, but want to consider approximate later
-
-    #look at each read in the fastq file.
-    #Using kmer method, try to align it to the desired and contaminant references
-    which_read = 0 #keep track of which read we're on
-    unassigned_reads = [] #keep track of which reads have been assigned to what
-    good_reads = []
-    cont_reads = []
-    count_good = []
-    count_cont = []
-
-    for entry in FQ:
-        read = entry['seq']
-        #print(read)
-        which_read += 1
-
-        #keep track of where each read has been assigned
-        in_des = 0
-        in_cont = 0
-        read_kmers = []
-        #make kmers from the read
-        for i in range(len(read)-k+1):
-            read_kmers.append(read[i:i+k])
-
-        idx_count = 0
-        for des_idx in des_idxs:
-
-            #check if the k_mers are in the desired reference
-            kmer_locs = []
-            for mer in read_kmers:
-
-                if mer in des_idx.keys(): ###here is the issue
-                    kmer_locs.append(des_idx[mer])
-            #print(kmer_locs)
-            #Check for alignments to the desired reference
-            if len(kmer_locs) >= len(read_kmers)-((k)*tolerance) and len(kmer_locs) > 0:
-#working here
-                #need to check the reference and calculate the hamming distance each start, as well as k, 2k, ... and (tolerance)k before it
-                new_starts = kmer_locs[0]
-                    #need to check the reference and calculate the hamming distance each start, as well as k, 2k, ... and (tolerance)k before it
-                    #need to compare the read to each read length section of the reference begining at each start point
-                for strt in new_starts:
-                    num_mismatch = 0
-                    compare = des_FAs[idx_count][strt:strt+len(read)]
-                    for base_num in range(len(read)):
-                        base = read[base_num]
-                    #to prevent checking  past edge of reference
-                        if base_num >= len(compare):
-                            #num_mismatch = tolerance +1
-                            break
-                        else:
-                            if base != compare[base_num]:
-                                num_mismatch += 1
-                            if num_mismatch > tolerance:
-                                break
-                     #add aligned reads to the dictionary to output
-                    if num_mismatch <= tolerance and which_read-1 not in count_good:
-                        des_count = des_count + 1
-                        in_des = 1
-                        count_good.append(which_read-1)
-                        good_reads.append(FQ[which_read-1])
-                        #if FQ[which_read-1] in unassigned_reads:
-                            #unassigned_reads.remove(FQ[which_read-1])
-                        break
-            idx_count += 1
-#check for each contaminant reference genome provided
-        count = 0
-        for cont_idx in cont_idxs:
-            if in_des != 1:
-                kmer_locs = []
-                for mer in read_kmers:
-                    if mer in cont_idx.keys():
-                        kmer_locs.append(cont_idx[mer])
-
-            #approximate matching with contminant reference
-                if len(kmer_locs) >= len(read_kmers)-((k)*tolerance) and len(kmer_locs) > 0: #filter which reads could potentially be a match by pigeonhole
-                    new_starts = kmer_locs[0]
-                        #need to check the reference and calculate the hamming distance each start, as well as k, 2k, ... and (tolerance)k before it
-                        #need to compare the read to each read length section of the reference begining at each start point
-                    for strt in new_starts:
-                        num_mismatch = 0
-                        compare = cont_FA[count][strt:strt+len(read)]
-                        for base_num in range(len(read)):
-                            base = read[base_num]
-                        #to prevent checking  past edge of reference
-                            if base_num >= len(compare):
-                                #num_mismatch = tolerance +1
-                                break
-                            else:
-                                if base != compare[base_num]:
-                                    num_mismatch += 1
-                                if num_mismatch > tolerance:
-                                    break
-
-                    #record reads assigned to a contaminant
-                    if num_mismatch <= tolerance and which_read-1 not in count_cont:
-                        cont_count = cont_count + 1
-                        in_cont = 1
-                        count_cont.append(which_read-1)
-                        cont_reads.append(FQ[which_read-1])
-                        #if FQ[which_read-1] in unassigned_reads:
-                            #unassigned_reads.remove(FQ[which_read-1])
-                        break
-            count += 1
-        #check if the read was unassigned to either a desired or contamination
-        if in_des == 0 and in_cont == 0:
-            unassigned_reads.append(FQ[which_read - 1])
-            unas_count = unas_count + 1
-
-    #return a list of the counts of reads mapped to the desired reference, a contamination reference, or unassigned
-    results = {"Desired": good_reads, "Contaminated": cont_reads, "Unassigned": unassigned_reads}
-    return results
+import json
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from data_utils.data_utils import sequence_checksum
+from data_utils.kmers import (canonical_kmers, encode_bases, encode_reads, kmer_codes, minimizer_offsets, mix64,
+                              reverse_complement_codes, reverse_complement_kmers)
+
+CACHE_PATH = "cache/kmer/"
+FORMAT_VERSION = 1 # version of the on-disk index and Bloom filter layout, stored in their headers
+BUILD_BYTES_PER_KMER = 64 # rough peak memory per k-mer while extracting and sorting a run
+
+
+class PackedPostings:
+    """
+        Compressed k-mer position lists, a drop-in for the flat positions array of a KmerIndex. Within each list the
+        positions are stored as gaps from the previous one, bit-packed in blocks of BLOCK gaps at the bit width of the
+        block's largest gap; the first position of every list is kept whole in firsts. Each block has a skip pointer to
+        its first bit, so any gap is read in O(1) without decoding its neighbours, and a query decodes only the lists
+        it hits. A position costs about log2 of the typical gap between occurrences of its k-mer plus a couple of bits
+        of block overhead, so the saving is large for the long lists of short k-mers in a big genome and nil for k-mers
+        that occur once.
+    """
+
+    BLOCK = 128
+
+    def __init__(self, positions, offsets, path=None, chunk_size=None):
+        """
+            Pack the flat positions array of a KmerIndex, whose list i is positions[offsets[i]:offsets[i + 1]].
+            Positions are packed chunk_size at a time (all at once by default). With path set, the packed arrays are
+            written there as .npy files and memory-mapped, so memory-mapped positions and offsets larger than RAM can be
+            packed within about chunk_size positions' worth of memory.
+        """
+        self.n = len(positions)
+        n_blocks = -(-self.n // self.BLOCK)
+        chunk = max(-(-(chunk_size or self.n) // self.BLOCK), 1) * self.BLOCK
+
+        def alloc(name, dtype, shape):
+            if path is None:
+                return np.zeros(shape, dtype=dtype)
+            return np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+
+        # First pass: each list's first position and each block's bit width
+        self.firsts = alloc("firsts", positions.dtype, (len(offsets) - 1,))
+        self.widths = alloc("widths", np.uint8, (n_blocks,))
+        for s in range(0, self.n, chunk):
+            chunk_positions, gaps, lists, list_starts = self._chunk_gaps(positions, offsets, s, min(s + chunk, self.n))
+            self.firsts[lists] = chunk_positions[list_starts]
+            self.widths[s // self.BLOCK:s // self.BLOCK + -(-len(gaps) // self.BLOCK)] = self._block_widths(gaps)
+        self.block_starts = alloc("block_starts", np.uint64, (n_blocks + 1,))
+        self.block_starts[0] = 0
+        self.block_starts[1:] = np.cumsum(np.asarray(self.widths, dtype=np.uint64) * np.uint64(self.BLOCK))
+
+        # Second pass: write the gaps. Blocks are a multiple of 64 bits long, so chunks never share a word
+        self.words = alloc("words", np.uint64, (int(self.block_starts[-1]) // 64 + 2,))
+        for s in range(0, self.n, chunk):
+            _, gaps, _, _ = self._chunk_gaps(positions, offsets, s, min(s + chunk, self.n))
+            self._write_gaps(gaps, s)
+        if path is not None:
+            for arr in (self.firsts, self.widths, self.block_starts, self.words):
+                arr.flush()
+
+    @staticmethod
+    def _chunk_gaps(positions, offsets, s, e):
+        """
+            Gaps of the flat positions [s, e), zero at the start of each list. Also returns the chunk's positions, the
+            lists starting in it and where they start in the chunk.
+        """
+        chunk_positions = np.asarray(positions[s:e])
+        prev = np.uint64(positions[s - 1]) if s else np.uint64(0)
+        gaps = np.diff(chunk_positions.astype(np.uint64), prepend=prev)
+        first, last = np.searchsorted(offsets, [s, e])
+        list_starts = np.asarray(offsets[first:last], dtype=np.int64) - s
+        gaps[list_starts] = 0
+        return chunk_positions, gaps, np.arange(first, last), list_starts
+
+    @classmethod
+    def _block_widths(cls, gaps):
+        """ Bit width of the largest gap of each block of BLOCK gaps. """
+        n_blocks = -(-len(gaps) // cls.BLOCK)
+        padded = np.zeros(n_blocks * cls.BLOCK, dtype=np.uint64)
+        padded[:len(gaps)] = gaps
+        block_max = padded.reshape(n_blocks, cls.BLOCK).max(axis=1) if n_blocks else np.zeros(0, dtype=np.uint64)
+        widths = np.zeros(n_blocks, dtype=np.uint8)
+        nonzero = block_max > 0
+        widths[nonzero] = np.floor(np.log2(block_max[nonzero].astype(np.float64))).astype(np.uint8) + 1
+        # float log2 can land one short just below a power of two
+        short = nonzero & (block_max >> widths.astype(np.uint64) > 0)
+        widths[short] += 1
+        return widths
+
+    def _write_gaps(self, gaps, s):
+        """ Bit-pack gaps into words, the first of them being the gap at flat index s (a multiple of BLOCK). """
+        bit, width = self._bit_of(np.arange(s, s + len(gaps)))
+        word, shift = (bit >> np.uint64(6)).astype(np.int64), bit & np.uint64(63)
+        spill = (shift + width > 64) & (shift > 0)
+        targets = np.concatenate((word, word[spill] + 1))
+        with np.errstate(over="ignore"):
+            parts = np.concatenate((gaps << shift, gaps[spill] >> (np.uint64(64) - shift[spill])))
+        order = np.argsort(targets, kind="stable")
+        targets, parts = targets[order], parts[order]
+        first = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]]) if len(targets) else np.zeros(0, dtype=np.int64)
+        if len(first):
+            self.words[targets[first]] = np.bitwise_or.reduceat(parts, first)
+
+    def _bit_of(self, flat):
+        """ First bit and bit width of the gaps at the given flat indexes. """
+        block = np.asarray(flat, dtype=np.int64) // self.BLOCK
+        width = self.widths[block].astype(np.uint64)
+        return self.block_starts[block] + (np.asarray(flat, dtype=np.uint64) % np.uint64(self.BLOCK)) * width, width
+
+    def gaps(self, flat):
+        """ Unpack the gaps at the given flat indexes. """
+        bit, width = self._bit_of(flat)
+        word, shift = (bit >> np.uint64(6)).astype(np.int64), bit & np.uint64(63)
+        value = self.words[word] >> shift
+        with np.errstate(over="ignore"):
+            high = np.where(shift > 0, self.words[word + 1] << (np.uint64(64) - shift), np.uint64(0))
+        mask = np.where(width > 0, (np.uint64(1) << width) - np.uint64(1), np.uint64(0))
+        return (value | high) & mask
+
+    def take(self, slots, counts, flat):
+        """
+            Positions of whole lists: flat indexes every hit of lists slots, list by list and each list from its start,
+            as built by KmerIndex.hits; counts are the list lengths.
+        """
+        running = np.cumsum(self.gaps(flat).astype(np.int64))
+        list_begin = np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(self.firsts[slots].astype(np.int64), counts) + running - running[list_begin]
+
+    def nbytes(self):
+        """ Memory used by the packed arrays. """
+        return sum(arr.nbytes for arr in self.arrays().values())
+
+    def arrays(self):
+        """ The arrays to persist. """
+        return {"firsts": self.firsts, "words": self.words, "widths": self.widths, "block_starts": self.block_starts}
+
+    @classmethod
+    def from_arrays(cls, n, firsts, words, widths, block_starts):
+        """ Rebuild packed postings from saved arrays. """
+        postings = cls.__new__(cls)
+        postings.n, postings.firsts, postings.words = n, firsts, words
+        postings.widths, postings.block_starts = widths, block_starts
+        return postings
+
+
+class KmerIndex:
+    """
+        Global k-mer index over every fragment of a list of FASTA objects, stored in CSR layout:
+            kmers - sorted unique k-mers, 2-bit packed into uint64
+            offsets - hits of kmers[i] are positions[offsets[i]:offsets[i + 1]]
+            positions - flat array of k-mer start positions in the concatenated fragments (a PackedPostings if compressed)
+            frag_starts - start of each fragment in the concatenated fragments
+            text - the concatenated fragments as base codes, used to verify alignments
+        With w set, only the (w, k)-minimizers of each fragment are indexed instead of every k-mer, which stores about
+        2 / (w + 1) of the positions; queries must then look up read minimizers computed the same way.
+        With max_occ set, k-mers occurring more than max_occ times are flagged as repetitive (see repetitive()) and the
+        aligners skip them as seeds, so a read costs at most max_occ hits per seed to verify.
+        With canonical set, k-mers are stored in canonical form (see data_utils.kmers.canonical_kmers), which covers both
+        strands with one index; strands holds, for each position, whether the reference k-mer there was flipped, so the
+        aligners can tell which strand a read hit.
+        With compress set, positions are stored as PackedPostings instead of a plain array.
+        All arrays can be saved to disk and memory-mapped back with load().
+    """
+
+    def __init__(self, FA, k, w=None, max_occ=None, canonical=False, compress=False):
+        """
+            Build the index from a list of FASTA objects and a k-mer length, optionally with a minimizer window, an
+            occurrence cap, canonical k-mers and compressed positions.
+        """
+        self.k = k
+        self.w = w
+        self.max_occ = max_occ
+        self.canonical = canonical
+        self.compressed = compress
+        self.ids = []
+        frag_codes, frag_kmers, frag_positions, frag_flips = [], [], [], []
+        start = 0
+        for entry in FA:
+            for i, frag in enumerate(entry):
+                codes = encode_bases(frag)
+                kmers, valid = kmer_codes(codes, k)
+                flipped = np.zeros(len(kmers), dtype=bool)
+                if canonical:
+                    kmers, flipped = canonical_kmers(kmers, k)
+                keep = np.flatnonzero(valid) if w is None else minimizer_offsets(kmers, valid, w)
+                frag_codes.append(codes)
+                frag_kmers.append(kmers[keep])
+                frag_positions.append(keep + start)
+                frag_flips.append(flipped[keep])
+                self.ids.append(entry.ids[i])
+                start += len(frag)
+
+        self.frag_starts = np.cumsum([0] + [len(c) for c in frag_codes])[:-1].astype(np.int64)
+        self.text = np.concatenate(frag_codes) if frag_codes else np.zeros(0, dtype=np.uint8)
+        all_kmers = np.concatenate(frag_kmers) if frag_kmers else np.zeros(0, dtype=np.uint64)
+        all_positions = np.concatenate(frag_positions) if frag_positions else np.zeros(0, dtype=np.int64)
+
+        # Stable sort keeps the positions of each k-mer in increasing order
+        order = np.argsort(all_kmers, kind="stable")
+        self.kmers, counts = np.unique(all_kmers[order], return_counts=True)
+        self.offsets = np.zeros(len(self.kmers) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        pos_type = np.uint32 if len(self.text) < 2**32 else np.int64
+        self.positions = all_positions[order].astype(pos_type)
+        self.strands = np.concatenate(frag_flips)[order] if canonical and frag_flips else None
+        if compress:
+            self.positions = PackedPostings(self.positions, self.offsets)
+
+    def lookup(self, kmers):
+        """ Find a batch of k-mers. Returns (slot, found); hits of kmers[i] are self.hits_of(slot[i]) if found[i]. """
+        slot = np.searchsorted(self.kmers, kmers)
+        found = slot < len(self.kmers)
+        found[found] = self.kmers[slot[found]] == kmers[found]
+        return slot, found
+
+    def repetitive(self, slot, found):
+        """ Flag the found k-mers of a lookup that occur more than max_occ times. """
+        if self.max_occ is None:
+            return np.zeros(len(found), dtype=bool)
+        counts = self.offsets[slot[found] + 1] - self.offsets[slot[found]]
+        flags = np.zeros(len(found), dtype=bool)
+        flags[found] = counts > self.max_occ
+        return flags
+
+    def occurrence_stats(self):
+        """ Summary of how often the indexed k-mers occur, and how much of the index the max_occ cap flags as repetitive. """
+        counts = np.diff(self.offsets)
+        stats = {"distinct": len(counts), "occurrences": int(counts.sum()),
+                 "mean": float(counts.mean()) if len(counts) else 0.0, "max": int(counts.max(initial=0))}
+        for q in (50, 90, 99, 99.9):
+            stats[f"p{q}"] = float(np.percentile(counts, q)) if len(counts) else 0.0
+        if self.max_occ is not None:
+            repeats = counts > self.max_occ
+            stats["repetitive"] = int(repeats.sum())
+            stats["repetitive_occurrences"] = int(counts[repeats].sum())
+        return stats
+
+    def hits_of(self, slot):
+        """ Positions of the k-mer stored at slot. """
+        return self.hits(np.array([slot]))[1]
+
+    def hits(self, slots, strands=False):
+        """
+            All hits of a batch of slots at once. Returns (which, positions): positions[i] is a hit of slots[which[i]].
+            With strands set, also returns whether the reference k-mer of each hit was flipped (canonical indexes only).
+        """
+        starts = self.offsets[slots]
+        counts = self.offsets[np.asarray(slots) + 1] - starts
+        which = np.repeat(np.arange(len(counts)), counts)
+        # index of each hit in the flat positions array: its slot's start plus its rank within the slot
+        flat = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        if self.compressed:
+            positions = self.positions.take(slots, counts, flat)
+        else:
+            positions = self.positions[flat].astype(np.int64)
+        if strands:
+            return which, positions, self.strands[flat]
+        return which, positions
+
+    def fragment_bounds(self, frags):
+        """ Start and end of each fragment in frags, in the concatenated coordinates. """
+        ends = np.append(self.frag_starts[1:], len(self.text))
+        return self.frag_starts[frags], ends[frags]
+
+    def fragment_of(self, positions):
+        """ Map positions in the concatenated fragments to (fragment index, offset in that fragment). """
+        frag = np.searchsorted(self.frag_starts, positions, side="right") - 1
+        return frag, positions - self.frag_starts[frag]
+
+    def fragment(self, f):
+        """ Base codes of fragment f. """
+        end = self.frag_starts[f + 1] if f + 1 < len(self.frag_starts) else len(self.text)
+        return self.text[self.frag_starts[f]:end]
+
+    def _array_names(self):
+        """ Names of the arrays that make up the index, besides the positions. """
+        names = ["kmers", "offsets", "frag_starts", "text"]
+        return names + ["strands"] if self.canonical else names
+
+    def save(self, path):
+        """ Write the index to a directory holding one .npy file per array plus a JSON header. """
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in self._array_names()}
+        arrays.update(self.positions.arrays() if self.compressed else {"positions": self.positions})
+        for name, arr in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), arr)
+        self.write_header(path, self.k, self.w, self.max_occ, self.canonical, self.ids, self.compressed)
+
+    @staticmethod
+    def write_header(path, k, w, max_occ, canonical, ids, compressed=False):
+        """ Write the JSON header describing the arrays in directory path. """
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump({"version": FORMAT_VERSION, "k": k, "w": w, "max_occ": max_occ, "canonical": canonical,
+                       "compressed": compressed, "ids": ids}, f)
+
+    @classmethod
+    def load(cls, path):
+        """ Memory-map an index written by save(). """
+        header = read_header(path)
+        if header is None:
+            raise FileNotFoundError(f"No k-mer index (format {FORMAT_VERSION}) at '{path}'")
+        index = cls.__new__(cls)
+        index.k = header["k"]
+        index.w = header["w"]
+        index.max_occ = header["max_occ"]
+        index.canonical = header["canonical"]
+        index.compressed = header["compressed"]
+        index.ids = header["ids"]
+        index.strands = None
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        for name in index._array_names():
+            setattr(index, name, load(name))
+        if index.compressed:
+            index.positions = PackedPostings.from_arrays(int(index.offsets[-1]), *(load(name) for name in ("firsts", "words", "widths", "block_starts")))
+        else:
+            index.positions = load("positions")
+        return index
+
+
+def read_header(path):
+    """ Return the JSON header of an index or Bloom filter saved in directory path, or None if there is no usable one. """
+    try:
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return header if header.get("version") == FORMAT_VERSION else None
+
+
+def build_kmer_index(FA, k, w=None, max_occ=None, canonical=False, compress=False):
+    """ Construct a k-mer index over every fragment of the given FASTA objects for a kmer length (minimizers only if w is set). """
+    return KmerIndex(FA, k, w, max_occ, canonical, compress)
+
+
+def _chunk_seeds(frag, a, b, k, w, canonical):
+    """
+        The (k-mer, offset, flipped) seeds of frag that the index keeps at k-mer offsets [a, b). For minimizers, every
+        window that can pick an offset in [a, b) is looked at, so the chunks together pick exactly what one pass would.
+    """
+    n = len(frag) - k + 1
+    lo, hi = (a, b) if w is None else (max(a - w + 1, 0), min(b + w - 1, n))
+    kmers, valid = kmer_codes(encode_bases(frag[lo:hi + k - 1]), k)
+    flipped = np.zeros(len(kmers), dtype=bool)
+    if canonical:
+        kmers, flipped = canonical_kmers(kmers, k)
+    keep = np.flatnonzero(valid) if w is None else minimizer_offsets(kmers, valid, w)
+    keep = keep[(keep + lo >= a) & (keep + lo < b)]
+    return kmers[keep], keep + lo, flipped[keep]
+
+
+def _write_runs(FA, k, w, canonical, text, run_dir, run_size):
+    """
+        Stream the fragments of FA in chunks, copying their base codes into text and writing their seeds, sorted by
+        k-mer, to run files of about run_size seeds each. Returns the list of run directories, in text order.
+    """
+    runs, buffered, n_buffered = [], [], 0
+
+    def flush():
+        kmers, positions, flips = (np.concatenate(parts) for parts in zip(*buffered))
+        order = np.argsort(kmers, kind="stable")
+        run = os.path.join(run_dir, str(len(runs)))
+        os.makedirs(run)
+        for name, arr in (("kmers", kmers), ("positions", positions), ("strands", flips)):
+            np.save(os.path.join(run, name + ".npy"), arr[order])
+        runs.append(run)
+        buffered.clear()
+
+    start = 0
+    for entry in FA:
+        for frag in entry:
+            for a in range(0, len(frag), run_size):
+                b = min(a + run_size, len(frag))
+                text[start + a:start + b] = encode_bases(frag[a:b])
+                kmers, offsets, flips = _chunk_seeds(frag, a, min(b, len(frag) - k + 1), k, w, canonical)
+                buffered.append((kmers, offsets + start, flips))
+                n_buffered += len(kmers)
+                if n_buffered >= run_size:
+                    flush()
+                    n_buffered = 0
+            start += len(frag)
+    if buffered:
+        flush()
+    return runs
+
+
+def _merge_runs(runs, path, block, canonical, pos_type):
+    """
+        Merge sorted runs into the kmers, offsets, positions (and strands) arrays of an index in directory path, reading
+        about block seeds of each run at a time. Runs are in text order and merged stably, so the positions of each
+        k-mer stay increasing.
+    """
+    run_arrays = [{name: np.load(os.path.join(run, name + ".npy"), mmap_mode="r")
+                   for name in ("kmers", "positions", "strands")} for run in runs]
+    total = sum(len(arrays["kmers"]) for arrays in run_arrays)
+    positions = np.lib.format.open_memmap(os.path.join(path, "positions.npy"), mode="w+", dtype=pos_type, shape=(total,))
+    strands = np.lib.format.open_memmap(os.path.join(path, "strands.npy"), mode="w+", dtype=bool, shape=(total,)) if canonical else None
+
+    # The number of distinct k-mers is only known at the end, so they and their counts are spilled to raw files first
+    raw_kmers, raw_counts = os.path.join(path, "kmers.raw"), os.path.join(path, "counts.raw")
+    cursors = [0] * len(runs)
+    written = 0
+    with open(raw_kmers, "wb") as kmer_file, open(raw_counts, "wb") as count_file:
+        while True:
+            live = [i for i, arrays in enumerate(run_arrays) if cursors[i] < len(arrays["kmers"])]
+            if not live:
+                break
+            # Everything up to the smallest last k-mer of the runs' next blocks can be merged without seeing more
+            cutoff = min(run_arrays[i]["kmers"][min(cursors[i] + block, len(run_arrays[i]["kmers"])) - 1] for i in live)
+            parts = []
+            for i in live:
+                kmers = run_arrays[i]["kmers"]
+                end = cursors[i] + int(np.searchsorted(kmers[cursors[i]:], cutoff, side="right"))
+                parts.append({name: arr[cursors[i]:end] for name, arr in run_arrays[i].items()})
+                cursors[i] = end
+            kmers = np.concatenate([part["kmers"] for part in parts])
+            order = np.argsort(kmers, kind="stable")
+            unique, counts = np.unique(kmers[order], return_counts=True)
+            kmer_file.write(unique.astype(np.uint64).tobytes())
+            count_file.write(counts.astype(np.int64).tobytes())
+            positions[written:written + len(kmers)] = np.concatenate([part["positions"] for part in parts])[order]
+            if canonical:
+                strands[written:written + len(kmers)] = np.concatenate([part["strands"] for part in parts])[order]
+            written += len(kmers)
+
+    n_unique = os.path.getsize(raw_kmers) // 8
+    kmers = np.lib.format.open_memmap(os.path.join(path, "kmers.npy"), mode="w+", dtype=np.uint64, shape=(n_unique,))
+    offsets = np.lib.format.open_memmap(os.path.join(path, "offsets.npy"), mode="w+", dtype=np.int64, shape=(n_unique + 1,))
+    offsets[0] = 0
+    if n_unique:
+        src_kmers = np.memmap(raw_kmers, dtype=np.uint64, mode="r")
+        src_counts = np.memmap(raw_counts, dtype=np.int64, mode="r")
+        for s in range(0, n_unique, block):
+            e = min(s + block, n_unique)
+            kmers[s:e] = src_kmers[s:e]
+            offsets[s + 1:e + 1] = offsets[s] + np.cumsum(src_counts[s:e])
+        del src_kmers, src_counts
+    for arr in (positions, strands, kmers, offsets):
+        if arr is not None:
+            arr.flush()
+    os.remove(raw_kmers)
+    os.remove(raw_counts)
+
+
+def build_kmer_index_external(FA, k, path, max_memory, w=None, max_occ=None, canonical=False, compress=False):
+    """
+        Build the same index as KmerIndex(FA, k, w, max_occ, canonical, compress) straight into directory path while
+        holding only about max_memory bytes of k-mers in RAM: the reference is streamed in chunks, each chunk's seeds are
+        sorted into a run file, and the runs are merged block by block into the final arrays. With compress set, the
+        merged positions are then bit-packed chunk by chunk. Returns the index memory-mapped from path. The directory is
+        written under a temporary name and renamed into place once complete.
+    """
+    run_size = max(max_memory // BUILD_BYTES_PER_KMER, 1)
+    lengths = [len(frag) for entry in FA for frag in entry]
+    ids = [entry.ids[i] for entry in FA for i in range(len(entry.ids))]
+    tmp = path.rstrip("/") + ".tmp%d" % os.getpid()
+    os.makedirs(tmp, exist_ok=True)
+
+    text = np.lib.format.open_memmap(os.path.join(tmp, "text.npy"), mode="w+", dtype=np.uint8, shape=(sum(lengths),))
+    np.save(os.path.join(tmp, "frag_starts.npy"), np.cumsum([0] + lengths)[:-1].astype(np.int64))
+    with tempfile.TemporaryDirectory(dir=tmp) as run_dir:
+        runs = _write_runs(FA, k, w, canonical, text, run_dir, run_size)
+        text.flush()
+        pos_type = np.uint32 if len(text) < 2**32 else np.int64
+        del text
+        _merge_runs(runs, tmp, max(run_size // max(len(runs), 1), 1), canonical, pos_type)
+    if compress:
+        positions_file = os.path.join(tmp, "positions.npy")
+        positions = np.load(positions_file, mmap_mode="r")
+        PackedPostings(positions, np.load(os.path.join(tmp, "offsets.npy"), mmap_mode="r"), tmp, run_size)
+        del positions
+        os.remove(positions_file)
+    KmerIndex.write_header(tmp, k, w, max_occ, canonical, ids, compress)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return KmerIndex.load(path)
+
+
+def cached_kmer_index(FA, k, name, max_memory, w=None, max_occ=None, canonical=False, cache=True, compress=False):
+    """
+        Load the on-disk k-mer index of FA from the cache, building it with build_kmer_index_external first if it is
+        missing or was built from different data. The index is always built on disk; with cache False, it is rebuilt
+        instead of reusing a cached copy.
+    """
+    checksum = sequence_checksum((frag for entry in FA for frag in entry), k, w, max_occ, canonical, compress)
+    path = CACHE_PATH + f"{name}_index_{checksum[:16]}"
+    if cache and read_header(path) is not None:
+        return KmerIndex.load(path)
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    return build_kmer_index_external(FA, k, path, max_memory, w, max_occ, canonical, compress)
+
+
+class KmerBloom:
+    """
+        Blocked Bloom filter over 2-bit packed k-mers. Each k-mer sets n_hashes bits inside a single 512-bit block
+        (8 uint64 words, one cache line), so a lookup touches one block instead of n_hashes random words.
+        The filter is sized for n_items distinct k-mers at the target false-positive rate fp_rate: about
+        -ln(fp_rate) / ln(2)^2 bits per k-mer, e.g. 9.6 bits at 1%. There are at most 4^k distinct k-mers, so at k=10
+        that is about 1.2 MB whatever the genome size; at k=31 a human genome's k-mers need a few GB.
+        It can be saved to disk and memory-mapped back like a KmerIndex.
+    """
+
+    BLOCK_WORDS = 8
+    BLOCK_BITS = 512
+
+    def __init__(self, n_items, fp_rate, k, seed=0):
+        """ Make an empty filter for about n_items k-mers of length k. """
+        n_items = max(n_items, 1)
+        bits = math.ceil(-n_items * math.log(fp_rate) / math.log(2) ** 2)
+        self.k = k
+        self.seed = seed
+        self.fp_rate = fp_rate
+        self.n_blocks = max(-(-bits // self.BLOCK_BITS), 1)
+        # 9 bits pick a bit within a block, so one 64-bit hash holds at most 7 probes
+        self.n_hashes = int(min(max(round(bits / n_items * math.log(2)), 1), 7))
+        self.words = np.zeros(self.n_blocks * self.BLOCK_WORDS, dtype=np.uint64)
+
+    def _probes(self, kmers):
+        """ Word index and bit mask of every probe of each k-mer, as two (len(kmers), n_hashes) arrays. """
+        block = mix64(kmers, self.seed) % np.uint64(self.n_blocks)
+        shifts = np.uint64(9) * np.arange(self.n_hashes, dtype=np.uint64)
+        bits = (mix64(kmers, self.seed + 1)[:, None] >> shifts) & np.uint64(self.BLOCK_BITS - 1)
+        word = (block[:, None] * np.uint64(self.BLOCK_WORDS) + (bits >> np.uint64(6))).astype(np.int64)
+        return word, np.uint64(1) << (bits & np.uint64(63))
+
+    def add(self, kmers, chunk_size=1000000):
+        """ Insert a 1D array of k-mers. """
+        for start in range(0, len(kmers), chunk_size):
+            word, mask = self._probes(np.asarray(kmers[start:start + chunk_size], dtype=np.uint64))
+            word, mask = word.ravel(), mask.ravel()
+            order = np.argsort(word, kind="stable")
+            word, mask = word[order], mask[order]
+            first = np.flatnonzero(np.r_[True, word[1:] != word[:-1]])
+            self.words[word[first]] |= np.bitwise_or.reduceat(mask, first)
+
+    def contains(self, kmers, chunk_size=1000000):
+        """ Test k-mers of any shape for membership; False is definite, True is wrong with probability ~fp_rate. """
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        flat = kmers.ravel()
+        found = np.zeros(len(flat), dtype=bool)
+        for start in range(0, len(flat), chunk_size):
+            word, mask = self._probes(flat[start:start + chunk_size])
+            found[start:start + chunk_size] = ((self.words[word] & mask) != 0).all(axis=1)
+        return found.reshape(kmers.shape)
+
+    def save(self, path):
+        """ Write the filter to a directory holding its bit array and a JSON header. """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "words.npy"), self.words)
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump({"version": FORMAT_VERSION, "k": self.k, "seed": self.seed, "fp_rate": self.fp_rate,
+                       "n_blocks": self.n_blocks, "n_hashes": self.n_hashes}, f)
+
+    @classmethod
+    def load(cls, path):
+        """ Memory-map a filter written by save(). """
+        header = read_header(path)
+        if header is None:
+            raise FileNotFoundError(f"No Bloom filter (format {FORMAT_VERSION}) at '{path}'")
+        bloom = cls.__new__(cls)
+        for name in ("k", "seed", "fp_rate", "n_blocks", "n_hashes"):
+            setattr(bloom, name, header[name])
+        bloom.words = np.load(os.path.join(path, "words.npy"), mmap_mode="r")
+        return bloom
+
+
+def build_kmer_bloom(FA, k, fp_rate, canonical=False):
+    """
+        Construct a Bloom filter of every (canonical, if set) k-mer in the given FASTA objects, at the target
+        false-positive rate. The filter is sized for the number of k-mer windows, or 4^k if that is smaller, since no
+        more k-mers than that can be distinct.
+    """
+    n_windows = sum(max(len(frag) - k + 1, 0) for entry in FA for frag in entry)
+    bloom = KmerBloom(min(n_windows, 4 ** k), fp_rate, k)
+    for entry in FA:
+        for frag in entry:
+            kmers, valid = kmer_codes(encode_bases(frag), k)
+            if canonical:
+                kmers, _ = canonical_kmers(kmers, k)
+            bloom.add(kmers[valid])
+    return bloom
+
+
+def cached_kmer_bloom(FA, k, fp_rate, name, cache=True, canonical=False):
+    """
+        Load the Bloom filter of FA from the cache, building and saving it first if the cached copy is missing or was
+        built from different data.
+    """
+    checksum = sequence_checksum((frag for entry in FA for frag in entry), k, fp_rate, canonical)
+    path = CACHE_PATH + f"{name}_bloom_{checksum[:16]}"
+    if cache and read_header(path) is not None:
+        return KmerBloom.load(path)
+    bloom = build_kmer_bloom(FA, k, fp_rate, canonical)
+    if cache:
+        bloom.save(path)
+    return bloom
+
+
+class KmerClassTable:
+    """
+        Kraken-style table mapping every k-mer of the references to the lowest common class of the references that
+        contain it, stored as a sorted uint64 key array with a parallel uint16 label array:
+            DESIRED - only in desired references
+            SHARED - in a desired reference and at least one contaminant
+            AMBIGUOUS - in several contaminant references, but no desired one
+            FIRST_CONTAMINANT + i - only in contaminant reference i (names[i])
+        Reads are then classified with one batched lookup of all their k-mers and a vote, see classify().
+        With canonical set, keys are canonical k-mers, so reads from either strand are classified alike.
+    """
+
+    DESIRED, SHARED, AMBIGUOUS, FIRST_CONTAMINANT = 0, 1, 2, 3
+    MISSING = np.iinfo(np.uint16).max
+
+    def __init__(self, des_refs, cont_refs, k, canonical=False):
+        """ Build the table from lists of desired and contaminant FASTA objects; each contaminant object is one reference. """
+        assert len(cont_refs) < self.MISSING - self.FIRST_CONTAMINANT, "too many contaminant references for uint16 labels"
+        self.k = k
+        self.canonical = canonical
+        self.names = [fasta.filename.split("/")[-1] for fasta in cont_refs]
+        groups = [(des_refs, self.DESIRED)] + [([fasta], self.FIRST_CONTAMINANT + i) for i, fasta in enumerate(cont_refs)]
+
+        all_keys, all_labels = [], []
+        for FA, label in groups:
+            # Deduplicate fragment by fragment, so memory peaks at one fragment's k-mers plus the distinct ones so far
+            keys = np.zeros(0, dtype=np.uint64)
+            for entry in FA:
+                for frag in entry:
+                    kmers, valid = kmer_codes(encode_bases(frag), k)
+                    keys = np.union1d(keys, self._keys(kmers)[valid])
+            all_keys.append(keys)
+            all_labels.append(np.full(len(keys), label, dtype=np.uint16))
+        keys = np.concatenate(all_keys)
+        labels = np.concatenate(all_labels)
+
+        # Each reference contributes a k-mer at most once, so after sorting by (key, label) the first and last label
+        # of a key's run are its smallest and largest reference label
+        order = np.lexsort((labels, keys))
+        keys, labels = keys[order], labels[order]
+        first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        last = np.append(first[1:], len(keys)) - 1
+        low, high = labels[first], labels[last]
+        self.keys = keys[first]
+        self.labels = np.where(low == high, low, np.where(low == self.DESIRED, self.SHARED, self.AMBIGUOUS)).astype(np.uint16)
+
+    def _keys(self, kmers):
+        """ The k-mers as stored in the table: canonical if the table is. """
+        return canonical_kmers(kmers, self.k)[0] if self.canonical else kmers
+
+    def lookup(self, kmers):
+        """ Labels of k-mers of any shape, MISSING for k-mers in no reference. """
+        kmers = self._keys(np.asarray(kmers, dtype=np.uint64))
+        if len(self.keys) == 0:
+            return np.full(kmers.shape, self.MISSING, dtype=np.uint16)
+        # Searching for the queries in sorted order walks the key array once instead of jumping around it
+        flat = kmers.ravel()
+        order = np.argsort(flat)
+        slot = np.empty(len(flat), dtype=np.int64)
+        slot[order] = np.searchsorted(self.keys, flat[order])
+        slot = np.minimum(slot, len(self.keys) - 1).reshape(kmers.shape)
+        return np.where(self.keys[slot] == kmers, self.labels[slot], self.MISSING)
+
+    def classify(self, kmers, valid, min_hits):
+        """
+            Vote on a batch of reads given their (n_reads, n_windows) k-mers and validity masks. A read is desired if at
+            least min_hits of its k-mers are in a desired reference, otherwise contaminated if at least min_hits are in a
+            contaminant one. Returns (desired, contaminated, source): source is the contaminant reference index with the
+            most reference-specific k-mers in the read, or -1 if it has none.
+        """
+        labels = np.where(valid, self.lookup(kmers), self.MISSING)
+        des_hits = np.count_nonzero((labels == self.DESIRED) | (labels == self.SHARED), axis=1)
+        cont_hits = np.count_nonzero((labels >= self.SHARED) & (labels != self.MISSING), axis=1)
+
+        # Per-reference votes from the k-mers unique to one contaminant
+        rows, cols = np.nonzero((labels >= self.FIRST_CONTAMINANT) & (labels != self.MISSING))
+        cells = rows * len(self.names) + labels[rows, cols].astype(np.int64) - self.FIRST_CONTAMINANT
+        votes = np.bincount(cells, minlength=len(labels) * len(self.names)).reshape(len(labels), len(self.names))
+        source = np.where(votes.max(axis=1, initial=0) > 0, votes.argmax(axis=1) if len(self.names) else -1, -1)
+
+        desired = des_hits >= min_hits
+        contaminated = ~desired & (cont_hits >= min_hits)
+        return desired, contaminated, source
+
+
+def hamming_within(text, read_codes, starts, lo, hi, tolerance, block=32):
+    """
+        Check, for each candidate start in the concatenated reference text, whether the read aligns there with at most
+        tolerance mismatches. Only bases inside [lo, hi) (the candidate's fragment) are compared, so reads hanging off
+        the edge of a fragment are judged on their overlap. All candidates are compared block by block as uint8 arrays,
+        and a candidate is dropped as soon as its mismatches exceed tolerance.
+    """
+    ok = np.zeros(len(starts), dtype=bool)
+    alive = np.arange(len(starts))
+    mismatches = np.zeros(len(starts), dtype=np.int64)
+    for col in range(0, len(read_codes), block):
+        cols = np.arange(col, min(col + block, len(read_codes)))
+        ref_pos = starts[alive, None] + cols
+        inside = (ref_pos >= lo[alive, None]) & (ref_pos < hi[alive, None])
+        ref = text[np.clip(ref_pos, 0, len(text) - 1)]
+        mismatches[alive] += np.count_nonzero(inside & (ref != read_codes[cols]), axis=1)
+        alive = alive[mismatches[alive] <= tolerance]
+        if len(alive) == 0:
+            break
+    ok[alive] = True
+    return ok
+
+
+def read_seeds(index, read_kmers):
+    """
+        The read's k-mers in the form the index stores them. Returns (kmers, flips); for a canonical index flips tells
+        which k-mers were reverse complemented, otherwise it is None.
+    """
+    if index.canonical:
+        return canonical_kmers(read_kmers, index.k)
+    return read_kmers, None
+
+
+def seed_diagonals(index, slots, offsets, flips, read_len):
+    """
+        Every hit of the read k-mers stored at slots, taken at the given read offsets. Returns (frags, strands, starts):
+        the fragment and read start each hit implies, with strand 1 where the hit is of the read's reverse complement.
+        A read k-mer matches the reverse strand when exactly one of it and the reference k-mer was flipped; the k-mer at
+        offset o of the read then sits at offset read_len - o - k of its reverse complement. A palindromic k-mer (its own
+        reverse complement) cannot tell the strands apart, so its hits count for both.
+    """
+    if index.canonical:
+        which, hit_pos, hit_flips = index.hits(slots, strands=True)
+        strands = (hit_flips != flips[which]).astype(np.int64)
+        stored = index.kmers[slots]
+        both = np.flatnonzero((reverse_complement_kmers(stored, index.k) == stored)[which])
+        which, hit_pos = np.append(which, which[both]), np.append(hit_pos, hit_pos[both])
+        strands = np.append(strands, 1 - strands[both])
+        starts = hit_pos - np.where(strands == 1, read_len - offsets[which] - index.k, offsets[which])
+    else:
+        which, hit_pos = index.hits(slots)
+        strands = np.zeros(len(hit_pos), dtype=np.int64)
+        starts = hit_pos - offsets[which]
+    frags, _ = index.fragment_of(hit_pos)
+    return frags, strands, starts
+
+
+def verify_candidates(index, read_codes, frags, strands, starts, tolerance):
+    """ True if the read (or, on strand 1, its reverse complement) aligns at one of the candidate starts. """
+    lo, hi = index.fragment_bounds(frags)
+    for strand, codes in ((0, read_codes), (1, reverse_complement_codes(read_codes))):
+        on = strands == strand
+        if on.any() and hamming_within(index.text, codes, starts[on], lo[on], hi[on], tolerance).any():
+            return True
+    return False
+
+
+def align_to_index(index, read_codes, read_kmers, read_valid, k, tolerance, max_diagonals=10):
+    """
+        Return True if the read aligns to some fragment of the index with at most tolerance mismatches.
+        Every hit of every read k-mer votes for the read start it implies (hit position minus the k-mer's offset in the
+        read). By the pigeonhole principle a true alignment keeps at least n_windows - k * tolerance k-mers on its
+        diagonal, so only diagonals with that many votes are verified, best-supported first, up to max_diagonals.
+        Repetitive k-mers cast no votes and lower the bound by one each.
+        On a canonical index, votes for the read and for its reverse complement are counted apart.
+    """
+    n_windows = len(read_kmers)
+    read_kmers, flips = read_seeds(index, read_kmers)
+    slot, found = index.lookup(read_kmers)
+    found &= read_valid
+    repeats = index.repetitive(slot, found)
+    found &= ~repeats
+    if not found.any():
+        return False
+
+    # Every hit of every found k-mer and the read start (diagonal) it implies
+    read_offsets = np.flatnonzero(found)
+    frags, strands, diagonals = seed_diagonals(index, slot[found], read_offsets, flips[found] if index.canonical else None, len(read_codes))
+
+    # Count votes per (fragment, strand, diagonal); hits in different fragments never vote together
+    key = np.stack((frags, strands, diagonals))
+    candidates, votes = np.unique(key, axis=1, return_counts=True)
+    enough = votes >= max(n_windows - k * tolerance - int(repeats.sum()), 1)
+    candidates, votes = candidates[:, enough], votes[enough]
+    if votes.size == 0:
+        return False
+    best = np.argsort(-votes, kind="stable")[:max_diagonals]
+    return verify_candidates(index, read_codes, *candidates[:, best], tolerance)
+
+
+def seed_offsets(read_len, k, tolerance):
+    """
+        Read offsets of tolerance + 1 non-overlapping k-mer seeds spread across a read of at least (tolerance + 1) * k
+        bases. A read with at most tolerance mismatches leaves at least one of them untouched (pigeonhole principle).
+    """
+    spacing = read_len // (tolerance + 1)
+    assert spacing >= k, f"a {read_len} bp read cannot hold {tolerance + 1} non-overlapping {k}-mers"
+    return np.arange(tolerance + 1) * spacing
+
+
+def verify_seed_hits(index, read_codes, offsets, seed_kmers, tolerance, max_candidates=None):
+    """
+        Look up seed k-mers taken at the given read offsets and verify the read starts their hits imply, those implied
+        by the most seeds first. Returns True if one of them aligns with at most tolerance mismatches.
+        Repetitive seeds are skipped, so the read is found only through its other seeds.
+    """
+    seed_kmers, flips = read_seeds(index, seed_kmers)
+    slot, found = index.lookup(seed_kmers)
+    found &= ~index.repetitive(slot, found)
+    if not found.any():
+        return False
+
+    frags, strands, diagonals = seed_diagonals(index, slot[found], offsets[found], flips[found] if index.canonical else None, len(read_codes))
+    candidates, votes = np.unique(np.stack((frags, strands, diagonals)), axis=1, return_counts=True)
+    best = np.argsort(-votes, kind="stable")[:max_candidates]
+    return verify_candidates(index, read_codes, *candidates[:, best], tolerance)
+
+
+def align_with_seeds(index, read_codes, read_kmers, read_valid, k, tolerance, max_diagonals=10):
+    """
+        Return True if the read aligns to some fragment of the index with at most tolerance mismatches, looking up only
+        tolerance + 1 disjoint seeds instead of every k-mer. Any true alignment has an exact seed, so verifying every
+        read start implied by a seed hit finds it. Reads too short to hold tolerance + 1 disjoint k-mers (e.g. after
+        adapter trimming) fall back to align_to_index.
+    """
+    if len(read_codes) < (tolerance + 1) * k:
+        return align_to_index(index, read_codes, read_kmers, read_valid, k, tolerance, max_diagonals)
+    offsets = seed_offsets(len(read_codes), k, tolerance)
+    offsets = offsets[read_valid[offsets]]
+    return verify_seed_hits(index, read_codes, offsets, read_kmers[offsets], tolerance)
+
+
+def align_with_minimizers(index, read_codes, read_kmers, read_valid, tolerance, max_diagonals=10):
+    """
+        Return True if the read aligns to some fragment of a minimizer index with at most tolerance mismatches. The read's
+        own (w, k)-minimizers are the seeds; up to max_diagonals of the best-supported read starts are verified.
+    """
+    offsets = minimizer_offsets(read_seeds(index, read_kmers)[0], read_valid, index.w)
+    return verify_seed_hits(index, read_codes, offsets, read_kmers[offsets], tolerance, max_diagonals)
+
+
+def kmer_class_engine(FQ, des_ref, cont_refs, k = 10, tolerance = 5, batch_size = 100000, canonical = False):
+    """
+        Classify reads with a KmerClassTable instead of aligning them. A read needs n_windows - k * tolerance k-mer hits
+        to be assigned, the same bound the aligner's diagonal voting uses. Besides the usual three lists, the results
+        hold "Attribution", the number of contaminated reads attributed to each contaminant reference.
+    """
+    table = KmerClassTable(des_ref, cont_refs, k, canonical)
+    results = {"Desired": [], "Contaminated": [], "Unassigned": []}
+    attribution = np.zeros(len(table.names) + 1, dtype=np.int64)
+
+    seqs = FQ.get_read_sequences()
+    for batch_start in range(0, len(seqs), batch_size):
+        batch = seqs[batch_start:batch_start + batch_size]
+        batch_kmers, batch_valid = kmer_codes(encode_reads(batch), k)
+        n_windows = np.maximum(np.array([len(read) for read in batch]) - k + 1, 0)
+        desired, contaminated, source = table.classify(batch_kmers, batch_valid, np.maximum(n_windows - k * tolerance, 1))
+        attribution += np.bincount(source[contaminated] + 1, minlength=len(attribution))
+
+        for r in range(len(batch)):
+            group = "Desired" if desired[r] else "Contaminated" if contaminated[r] else "Unassigned"
+            results[group].append(FQ[batch_start + r])
+
+    results["Attribution"] = {name: int(n) for name, n in zip(table.names, attribution[1:]) if n}
+    if attribution[0]:
+        results["Attribution"]["(shared)"] = int(attribution[0])
+    return results
+
+
+def kmer_engine(FQ, des_ref, cont_refs, k = 10, tolerance = 5, batch_size = 100000, max_diagonals = 10, seeding = "all", minimizer_window = None, bloom_fp_rate = None, cache = True, classify = False, max_occ = None, canonical = False, max_memory = None, compress = False): #requires the desired reference to be input as a single fasta file, contaminant can be multi fasta
+    #Inputs must be fastq and fasta objects, with integers for k and tolerance
+    #seeding is "all" to look up every k-mer of a read, or "pigeonhole" to look up only tolerance + 1 disjoint seeds
+    #minimizer_window, if set, makes the desired index store only (w, k)-minimizers with w = minimizer_window
+    #bloom_fp_rate, if set, pre-screens reads against a Bloom filter of desired k-mers (cached on disk unless cache is False)
+    #max_occ, if set, skips k-mers occurring more than max_occ times in a reference as seeds, bounding verification work
+    #canonical, if set, indexes canonical k-mers so reads from either strand of a reference are found
+    #max_memory, if set, builds the indexes on disk under cache/kmer within about max_memory bytes and memory-maps them (reused across runs unless cache is False)
+    #compress, if set, stores the indexes' position lists bit-packed (see PackedPostings)
+    #classify, if set, skips alignment and classifies every read with a single k-mer -> class table lookup and vote
+    """Returns three dictionaries containing which reads allign to the desired reference, a contaminant reference, or neither"""
+    if classify:
+        return kmer_class_engine(FQ, des_ref, cont_refs, k, tolerance, batch_size, canonical)
+
+    #make indexes from desired references
+    if max_memory is not None:
+        des_idx = cached_kmer_index(des_ref, k, "desired", max_memory, minimizer_window, max_occ, canonical, cache, compress)
+    else:
+        des_idx = build_kmer_index(des_ref, k, minimizer_window, max_occ, canonical, compress)
+    des_bloom = cached_kmer_bloom(des_ref, k, bloom_fp_rate, "desired", cache, canonical) if bloom_fp_rate is not None else None
+
+    #make indexes from contamination references
+    if max_memory is not None:
+        cont_idx = cached_kmer_index(cont_refs, k, "contaminant", max_memory, max_occ=max_occ, canonical=canonical, cache=cache, compress=compress)
+    else:
+        cont_idx = build_kmer_index(cont_refs, k, max_occ=max_occ, canonical=canonical, compress=compress)
+
+    #report how much of each index the repeat cap takes out of play, to help choose max_occ
+    if max_occ is not None:
+        for name, idx in (("Desired", des_idx), ("Contaminant", cont_idx)):
+            stats = idx.occurrence_stats()
+            print(f"{name} index: {stats['distinct']} distinct k-mers, {stats['occurrences']} positions, occurrences per k-mer "
+                  f"p50 {stats['p50']:g} / p99 {stats['p99']:g} / p99.9 {stats['p99.9']:g} / max {stats['max']}; "
+                  f"{stats['repetitive']} k-mers ({stats['repetitive_occurrences']} positions) over max_occ = {max_occ} are skipped")
+
+    def aligns(idx, read_codes, read_kmers, read_valid):
+        if idx.w is not None:
+            return align_with_minimizers(idx, read_codes, read_kmers, read_valid, tolerance, max_diagonals)
+        if seeding == "pigeonhole":
+            return align_with_seeds(idx, read_codes, read_kmers, read_valid, k, tolerance, max_diagonals)
+        return align_to_index(idx, read_codes, read_kmers, read_valid, k, tolerance, max_diagonals)
+
+    good_reads = []
+    cont_reads = []
+    unassigned_reads = []
+
+    #look at each read in the fastq file.
+    #Using kmer method, try to align it to the desired and contaminant references
+    seqs = FQ.get_read_sequences()
+    for batch_start in range(0, len(seqs), batch_size):
+        #make kmers from a whole batch of reads at once
+        batch = seqs[batch_start:batch_start + batch_size]
+        read_matrix = encode_reads(batch)
+        batch_kmers, batch_valid = kmer_codes(read_matrix, k)
+
+        #A read within tolerance mismatches of the desired reference shares at least n_windows - k * tolerance of its
+        #k-mers with it, the same bound diagonal voting uses, so reads with fewer Bloom hits skip the desired index
+        maybe_desired = np.ones(len(batch), dtype=bool)
+        if des_bloom is not None:
+            screen_kmers = canonical_kmers(batch_kmers, k)[0] if canonical else batch_kmers
+            bloom_hits = np.count_nonzero(des_bloom.contains(screen_kmers) & batch_valid, axis=1)
+            n_windows = np.maximum(np.array([len(read) for read in batch]) - k + 1, 0)
+            maybe_desired = bloom_hits >= np.maximum(n_windows - k * tolerance, 1)
+
+        for r, read in enumerate(batch):
+            entry = FQ[batch_start + r]
+            n_windows = max(len(read) - k + 1, 0)
+            read_codes = read_matrix[r, :len(read)]
+            read_kmers = batch_kmers[r, :n_windows]
+            read_valid = batch_valid[r, :n_windows]
+
+            if maybe_desired[r] and aligns(des_idx, read_codes, read_kmers, read_valid):
+                good_reads.append(entry)
+            elif aligns(cont_idx, read_codes, read_kmers, read_valid):
+                cont_reads.append(entry)
+            else:
+                unassigned_reads.append(entry)
+
+    #return a list of the reads mapped to the desired reference, a contamination reference, or unassigned
+    results = {"Desired": good_reads, "Contaminated": cont_reads, "Unassigned": unassigned_reads}
+    return results
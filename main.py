@@ -10,6 +10,14 @@ from smithwaterman import sw_engine
 from minhash import minhash_engine
 
 
+def parse_memory_size(text):
+    """ Parse a memory size such as 512M, 8G or a plain number of bytes into a number of bytes. """
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
 def parse_args():
     """ Parse command line arguments. """
     parser = argparse.ArgumentParser(description="This is the main driver file for our contaminant detection pipeline.")
@@ -19,8 +27,35 @@ def parse_args():
     parser.add_argument("--query", nargs=1, dest="query", type=str, required=True, help="Path of FASTQ files to check for contamination, or a path to a folder containing the FASTQ files. Only 1 file can be provided at a time.")
     parser.add_argument("--engine", type=str, required=True, choices=["kmer", "fm", "sw", "minhash"], help="Method to use for contaminant detection. Options: kmer = K-mer index, fm = FM index, sw = Smith-Waterman, minhash = Minhash")
     parser.add_argument("--save", dest="save", action="store_true", help="Save cleaned FASTQ file to disk. If omitted, file will not be saved.")
+    parser.add_argument("--fm-single-index", dest="fm_single_index", action="store_true", help="FM engine only: build one FM index over all desired and contaminant fragments instead of one index per fragment.")
+
+    parser.add_argument("--fm-mismatches", dest="fm_mismatches", type=int, default=0, help="FM engine only: also assign reads that match a reference with up to this many substitutions (e.g. 1 or 2 for sequencing errors). Default is exact matching only.")
+
+    parser.add_argument("--fm-compact", dest="fm_compact", action="store_true", help="FM engine only: store the BWT 2-bit packed (about 0.4 bytes per base instead of 2) at a small cost in query speed.")
+
+    parser.add_argument("--kmer-seeding", dest="kmer_seeding", type=str, default="all", choices=["all", "pigeonhole"], help="K-mer engine only: look up every k-mer of each read (all) or only tolerance + 1 non-overlapping seeds (pigeonhole; reads too short for them look up every k-mer). Default is all.")
+
+    parser.add_argument("--kmer-minimizer-window", dest="kmer_minimizer_window", type=int, default=None, help="K-mer engine only: index only the (w, k)-minimizers of the desired reference, with this window size w. Default is to index every k-mer.")
+
+    parser.add_argument("--kmer-bloom-fp-rate", dest="kmer_bloom_fp_rate", type=float, default=None, help="K-mer engine only: pre-screen reads with a Bloom filter of desired k-mers, sized for this false-positive rate (e.g. 0.01). Reads with too few hits skip the desired index.")
+
+    parser.add_argument("--kmer-classify", dest="kmer_classify", action="store_true", help="K-mer engine only: skip alignment and classify each read with one lookup of its k-mers in a k-mer -> class table built from all references, reporting which contaminant each read came from.")
+
+    parser.add_argument("--kmer-max-occ", dest="kmer_max_occ", type=int, default=None, help="K-mer engine only: skip k-mers that occur more than this many times in a reference as seeds, bounding the verification work per read on repetitive genomes. Occurrence statistics of each index are printed to help pick the cap. Default is no cap.")
 
-    parser.set_defaults(save=False)
+    parser.add_argument("--canonical", dest="canonical", action="store_true", help="K-mer and MinHash engines only: use canonical k-mers (the smaller of a k-mer and its reverse complement) so reads from either strand of a reference are detected.")
+
+    parser.add_argument("--max-memory", dest="max_memory", type=parse_memory_size, default=None, help="K-mer engine only: build the k-mer indexes on disk (under cache/kmer) using at most about this much memory, e.g. 8G, and memory-map them. Default is to build them in RAM.")
+
+    parser.add_argument("--kmer-compress", dest="kmer_compress", action="store_true", help="K-mer engine only: keep the k-mer position lists of the indexes bit-packed as gaps, trading some lookup speed for memory. Works with --max-memory, which then packs them on disk.")
+
+    parser.add_argument("--minhash-hashing", dest="minhash_hashing", type=str, default="xxhash", choices=["xxhash", "mix64"], help="MinHash engine only: hash k-mer strings with xxhash (matches the sketches in cache/minhash) or hash 2-bit packed k-mers in bulk with the splitmix64 finalizer (mix64, much faster to build, cached separately). Default is xxhash.")
+
+    parser.add_argument("--minhash-exact", dest="minhash_exact", action="store_true", help="MinHash engine only: score each read by the exact fraction of its k-mers found in every reference sketch at once, instead of by estimating containment from a read sketch. Only k-mers hashing below a fixed-size sketch's largest hash can be tested, which for a large genome leaves most short reads none; those reads fall back to the estimate (with a warning). Combine with --minhash-scaled for exact scores on short reads.")
+
+    parser.add_argument("--minhash-scaled", dest="minhash_scaled", type=int, default=None, help="MinHash engine only: use FracMinHash sketches keeping about 1 in this many k-mer hashes (e.g. 10 for short reads) instead of fixed-size sketches, and classify reads by looking up their retained hashes. Scaled sketches are cached separately.")
+
+    parser.set_defaults(save=False, fm_single_index=False, fm_compact=False, kmer_classify=False, canonical=False, kmer_compress=False, minhash_exact=False)
 
     return parser.parse_args()
 
@@ -75,16 +110,16 @@ def main():
     engine = args.engine
     if engine == "kmer":
         print("Running k-mer index engine...\n")
-        results = kmer_engine(FQ, des_FA, cont_FA)
+        results = kmer_engine(FQ, des_FA, cont_FA, seeding=args.kmer_seeding, minimizer_window=args.kmer_minimizer_window, bloom_fp_rate=args.kmer_bloom_fp_rate, classify=args.kmer_classify, max_occ=args.kmer_max_occ, canonical=args.canonical, max_memory=args.max_memory, compress=args.kmer_compress)
     elif engine == "fm":
         print("Running FM index engine...\n")
-        results = fm_engine(des_FA, cont_FA, [FQ]) # TODO: args
+        results = fm_engine(des_FA, cont_FA, [FQ], single_index=args.fm_single_index, mismatches=args.fm_mismatches, compact=args.fm_compact)
     elif engine == "sw":
         print("Running Smith-Waterman engine...\n")
         results = sw_engine(FQ, des_FA, cont_FA)
     elif engine == "minhash":
         print("Running MinHash engine...\n")
-        results = minhash_engine(cont_FA, des_FA, FQ)
+        results = minhash_engine(cont_FA, des_FA, FQ, canonical=args.canonical, hashing=args.minhash_hashing, exact=args.minhash_exact, scaled=args.minhash_scaled)
     else:
         # The command line args should already validate the engine selection, so this line will likely never be run.
         raise ValueError("Invalid engine for contaminant detection.")
@@ -98,6 +133,10 @@ def main():
     print(f"Desired: {des_percent}%")
     print(f"Unassigned: {unassigned_percent}%")
 
+    # Engines that can tell contaminants apart also report where the contaminated reads came from
+    for name, count in results.get("Attribution", {}).items():
+        print(f"  {name}: {round(100 * count / len(FQ), 2)}%")
+
     # Optionally create output file with contaminated reads removed
     if args.save:
         print("\nCreating cleaned file...")
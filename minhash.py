@@ -1,11 +1,20 @@
+import glob
 import heapq
+import json
+import os
 import numpy as np
 import sys
 import xxhash
 
-from data_utils.data_utils import save_object_to_file, load_object_from_file
+from data_utils.data_utils import load_object_from_file, sequence_checksum
+from data_utils.kmers import encode_bases, encode_reads, kmer_codes, decode_kmers, canonical_kmers, mix64
 
 CACHE_PATH = "cache/minhash/"
+SKETCH_DB = "sketches.db" # sketch database file inside CACHE_PATH
+SKETCH_DB_MAGIC = b"CGSKETCH"
+SKETCH_DB_VERSION = 1
+LEGACY_K = 21 # k of the pickled sketches older versions cached, which did not record it
+CHUNK_SIZE = 1000000 # number of reference k-mers extracted at a time
 
 class HashXX32:
     """
@@ -142,74 +151,517 @@ class MinHash:
         return (size_A + size_B - size_AB_union) / size_AB_union
 
 
-def make_kmers(dna, k):
-    """ Generate list of k-mers from the given DNA string.  """
-    return [dna[i:i + k] for i in range(len(dna) - k + 1)]
+def hash_kmers(kmers, seed=0):
+    """
+        Hash an array of 2-bit packed k-mers in one vectorized pass with the splitmix64 finalizer (see
+        data_utils.kmers.mix64), over the full uint64 range. The same k-mers and seed always give the same hashes.
+    """
+    return mix64(kmers, seed)
+
+
+class BottomKSketch:
+    """
+        MinHash bottom-k sketch kept as a sorted uint64 array of the sketch_size smallest distinct hash values, which
+        takes a whole array of hashes per update instead of one token at a time.
+        With hashing="xxhash" it hashes tokens like MinHash and its estimates use the same formulas, so for the same
+        tokens both classes give the same answers; from_minhash() converts an existing (e.g. cached) MinHash sketch.
+        With hashing="mix64", k-mers are hashed straight from their 2-bit codes by hash_kmers, with no per-k-mer
+        Python call; these sketches are not comparable with xxhash ones.
+    """
+
+    def __init__(self, sketch_size, data=None, seed=0, id=None, hashing="xxhash"):
+        """
+            Construct an empty sketch.
+            Args:
+                sketch_size - how many hash values to maintain in each sketch
+                data - optionally, list of tokens to add
+                seed - optionally, set the random seed used in the hash function
+                hashing - "xxhash" to hash k-mer strings like MinHash, or "mix64" to hash 2-bit packed k-mers
+        """
+        assert hashing in ("xxhash", "mix64"), f"unknown hashing {hashing}"
+        self.id = id
+        self.sketch_size = sketch_size
+        self.seed = seed
+        self.hashing = hashing
+        self._hasher = HashXX64(seed)
+        self._max_hash_val = 2**64
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        if data:
+            self.update_tokens(data)
+
+    @classmethod
+    def from_minhash(cls, minhash):
+        """ Convert a MinHash sketch into the equivalent BottomKSketch. """
+        sketch = cls(len(minhash.get_heap()), seed=minhash._hasher.seed if minhash._hasher else 0, id=minhash.id)
+        sketch.hashes = np.array(sorted(-h for h in minhash.get_heap() if -h < minhash._max_hash_val), dtype=np.uint64)
+        return sketch
+
+    def __getstate__(self):
+        # The xxhash object cannot be pickled; it is rebuilt from the seed on load
+        state = self.__dict__.copy()
+        state["_hasher"] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("hashing", "xxhash")
+        self.__dict__.update(state)
+        self._hasher = HashXX64(self.seed)
+
+    def update(self, obj):
+        """ Add a single token to the sketch. """
+        self.update_tokens([obj])
+
+    def update_kmers(self, kmers, k):
+        """ Add an array of 2-bit packed k-mers, hashed the way this sketch hashes. """
+        if self.hashing == "mix64":
+            self.update_hashes(hash_kmers(kmers, self.seed))
+        else:
+            self.update_tokens(kmer_tokens(kmers, k))
+
+    def update_tokens(self, tokens):
+        """ Hash a list of tokens and add them all to the sketch. """
+        self.update_hashes(np.fromiter((self._hasher.hash(t) for t in tokens), dtype=np.uint64, count=len(tokens)))
+
+    def update_hashes(self, hashes):
+        """
+            Add an array of hash values to the sketch in one go: drop values that cannot make it into the sketch,
+            partition out a small candidate set, deduplicate it and merge it with the current sorted values.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(self.hashes) == self.sketch_size:
+            hashes = hashes[hashes < self.hashes[-1]]
+        if len(hashes) > 2 * self.sketch_size:
+            # The 2 * sketch_size smallest values hold sketch_size distinct ones unless there are many duplicates
+            cut = np.partition(hashes, 2 * self.sketch_size - 1)[2 * self.sketch_size - 1]
+            candidates = np.unique(hashes[hashes <= cut])
+            hashes = candidates if len(candidates) >= self.sketch_size else np.unique(hashes)
+        self.hashes = np.union1d(self.hashes, hashes)[:self.sketch_size]
+
+    def get_hashes(self):
+        """ Return the sorted hash values in the sketch. """
+        return self.hashes
+
+    def threshold(self):
+        """ The largest hash value the sketch could hold: membership of any hash up to it is exact. """
+        return int(self.hashes[-1]) if len(self.hashes) >= self.sketch_size else self._max_hash_val - 1
+
+    def _kth(self, hashes):
+        """ The sketch_size-th smallest of sorted hash values, or the hash range if there are fewer. """
+        return int(hashes[self.sketch_size - 1]) if len(hashes) >= self.sketch_size else self._max_hash_val
+
+    def cardinality(self):
+        """ Return the estimated cardinality of the sketch. """
+        return (self.sketch_size * self._max_hash_val / self._kth(self.hashes)) - 1
 
-def build_ref_sketches(fasta_objects, k, sketch_size, cache=True):
+    def union(self, b):
+        """ Return the union sketch (A and B), as sorted hash values. """
+        return np.union1d(self.hashes, b.get_hashes())[:self.sketch_size]
+
+    def size_union(self, B):
+        """ Return the size of union sketch (|A and B|). """
+        return (self.sketch_size * self._max_hash_val / self._kth(self.union(B))) - 1
+
+    def containment(self, B):
+        """
+            Estimate the containment of A in B.
+            Calculate: |sketch(A).intersection(sketch(B))| / |sketch(A)|
+        """
+        size_A = self.cardinality()
+        size_B = B.cardinality()
+        size_AB_union = self.size_union(B)
+        return (size_A + size_B - size_AB_union) / size_A
+
+    def similarity(self, B):
+        """
+            Estimate the Jaccard similarity between A and B.
+            Calculate: |sketch(A).intersection(sketch(B))| / |sketch(A).union(sketch(B))|
+        """
+        size_A = self.cardinality()
+        size_B = B.cardinality()
+        size_AB_union = self.size_union(B)
+        return (size_A + size_B - size_AB_union) / size_AB_union
+
+
+class ScaledSketch(BottomKSketch):
+    """
+        FracMinHash (scaled) sketch: keeps every distinct hash up to max_hash / scaled instead of a fixed number of the
+        smallest ones, so it grows with the sequence (about one hash per scaled k-mers) and sketches of any two
+        sequences are compared exactly over the hash range they share. Reads and references are sketched the same way.
+    """
+
+    def __init__(self, scaled, data=None, seed=0, id=None, hashing="xxhash"):
+        """
+            Construct an empty sketch keeping hashes up to max_hash / scaled.
+            The other arguments are as for BottomKSketch.
+        """
+        self.scaled = scaled
+        # xxhash values are reduced mod sys.maxsize, mix64 ones span the whole uint64 range
+        max_hash = 2**64 - 1 if hashing == "mix64" else sys.maxsize - 1
+        self.max_hash = max_hash // scaled
+        super().__init__(None, data, seed, id, hashing)
+
+    def update_hashes(self, hashes):
+        """ Add an array of hash values to the sketch, keeping those up to max_hash. """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        self.hashes = np.union1d(self.hashes, hashes[hashes <= np.uint64(self.max_hash)])
+
+    def threshold(self):
+        """ The largest hash value the sketch could hold: membership of any hash up to it is exact. """
+        return self.max_hash
+
+    def _shared_range(self, B):
+        """ Both sketches' hashes, cut down to the range both of them keep. """
+        t = np.uint64(min(self.threshold(), B.threshold()))
+        return self.hashes[self.hashes <= t], B.get_hashes()[B.get_hashes() <= t]
+
+    def cardinality(self):
+        """ Return the estimated cardinality of the sketch. """
+        return len(self.hashes) * self.scaled
+
+    def union(self, b):
+        """ Return the union sketch (A and B), as sorted hash values. """
+        return np.union1d(*self._shared_range(b))
+
+    def size_union(self, B):
+        """ Return the size of union sketch (|A and B|). """
+        return len(self.union(B)) * self.scaled
+
+    def containment(self, B):
+        """ Return the fraction of A's hashes (in the range both keep) that are in B. """
+        a, b = self._shared_range(B)
+        return np.isin(a, b).sum() / max(len(a), 1)
+
+    def similarity(self, B):
+        """ Return the Jaccard similarity of A's and B's hashes, in the range both keep. """
+        a, b = self._shared_range(B)
+        return len(np.intersect1d(a, b)) / max(len(np.union1d(a, b)), 1)
+
+
+class SketchPanel:
+    """
+        All reference sketches stacked into one sorted uint64 hash array with a parallel reference-id array, so a batch
+        of reads is scored against every reference in one searchsorted pass. thresholds[r] is the largest hash
+        reference r's sketch could hold, so whether a hash up to it is in the sketch is known exactly.
+        The sorted arrays are an inverted index from hash to the references that hold it: a read's hashes above every
+        threshold are dropped up front, and the rest are looked up once whatever the number of references.
+    """
+
+    def __init__(self, sketches):
+        """ Stack a list of sketches; reference r is sketches[r]. """
+        lengths = [len(s.get_hashes()) for s in sketches]
+        hashes = np.concatenate([s.get_hashes() for s in sketches]) if sketches else np.zeros(0, dtype=np.uint64)
+        refs = np.repeat(np.arange(len(sketches), dtype=np.int32), lengths)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes, self.refs = hashes[order], refs[order]
+        self.thresholds = np.array([s.threshold() for s in sketches], dtype=np.uint64)
+
+    def containment(self, hashes, reads, n_reads):
+        """
+            Exact containment of each read in every reference. The reads are given as the distinct hashes of all their
+            k-mers (hashes) and the read each hash belongs to (reads). Returns two (n_reads, n_refs) matrices: the
+            fraction of a read's hashes up to a reference's threshold that are in its sketch (0 if none are that small),
+            and the number of such testable hashes. A bottom-k sketch of a large genome has a tiny threshold, so most
+            short reads have no testable hash against it at all.
+        """
+        n_refs = len(self.thresholds)
+        if n_refs:
+            kept = hashes <= self.thresholds.max()
+            hashes, reads = hashes[kept], reads[kept]
+        lo = np.searchsorted(self.hashes, hashes, side="left")
+        counts = np.searchsorted(self.hashes, hashes, side="right") - lo
+        which = np.repeat(np.arange(len(hashes)), counts)
+        flat = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        shared = np.bincount(reads[which] * n_refs + self.refs[flat], minlength=n_reads * n_refs).reshape(n_reads, n_refs)
+        # References sharing a threshold (all of them, for scaled sketches) share the count of testable hashes
+        levels, level_of = np.unique(self.thresholds, return_inverse=True)
+        testable = np.stack([np.bincount(reads[hashes <= t], minlength=n_reads) for t in levels], axis=1)[:, level_of] if n_refs else shared
+        return shared / np.maximum(testable, 1), testable
+
+
+def read_hashes(kmers, valid, k, seed=0, hashing="xxhash"):
+    """
+        Hash every valid k-mer of a batch of reads, given as (n_reads, n_windows) k-mer and validity matrices, the way a
+        BottomKSketch with the same seed and hashing would. Returns (hashes, reads): the distinct hashes of each read
+        and the row each came from.
+    """
+    reads = np.nonzero(valid)[0]
+    if hashing == "mix64":
+        hashes = hash_kmers(kmers[valid], seed)
+    else:
+        hasher = HashXX64(seed)
+        hashes = np.fromiter((hasher.hash(t) for t in kmer_tokens(kmers[valid], k)), dtype=np.uint64, count=len(reads))
+    order = np.lexsort((hashes, reads))
+    reads, hashes = reads[order], hashes[order]
+    keep = np.r_[True, (reads[1:] != reads[:-1]) | (hashes[1:] != hashes[:-1])] if len(reads) else np.zeros(0, dtype=bool)
+    return hashes[keep], reads[keep]
+
+
+def sketch_params(sketch, k, canonical):
+    """ The parameters a cached sketch must match to be reused, besides the contents of its FASTA file. """
+    return {"k": k, "seed": sketch.seed, "hashing": sketch.hashing, "canonical": canonical,
+            "sketch_size": sketch.sketch_size, "scaled": getattr(sketch, "scaled", None)}
+
+
+def fasta_checksum(fasta):
+    """ SHA-1 of the fragments of a FASTA object, to tell when a cached sketch was built from different data. """
+    return sequence_checksum(fasta)
+
+
+class SketchDatabase:
+    """
+        Many reference sketches in one versioned binary file, loaded with a single memory map:
+            magic (8 bytes) | version (uint64) | header length in bytes (uint64) | JSON header, zero-padded to 8 bytes |
+            the hash arrays of every sketch, back to back, as little-endian uint64
+        Each header entry records the FASTA file name, its content checksum, the sketch parameters (k, seed, hashing,
+        canonical, sketch_size, scaled) and where its hashes are (offset and length, in hashes). A sketch is only
+        reused if all of these match, so changing k, the sketch size or the FASTA contents rebuilds it.
+    """
+
+    def __init__(self, path):
+        """ Open the database at path, or start an empty one if the file does not exist yet. """
+        self.path = path
+        self.entries = []
+        self.arrays = []
+        self.added = set()
+        self.dirty = False
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            magic = f.read(len(SKETCH_DB_MAGIC))
+            sizes = f.read(16)
+            if magic != SKETCH_DB_MAGIC or len(sizes) != 16:
+                raise ValueError(f"{path} is not a sketch database")
+            version, header_len = np.frombuffer(sizes, dtype="<u8")
+            if version != SKETCH_DB_VERSION:
+                raise ValueError(f"{path} has sketch database version {version}, expected {SKETCH_DB_VERSION}")
+            self.entries = json.loads(f.read(int(header_len)).rstrip(b"\0"))
+        data_offset = len(SKETCH_DB_MAGIC) + 16 + int(header_len)
+        total = sum(entry["length"] for entry in self.entries)
+        data = np.memmap(path, dtype="<u8", mode="r", offset=data_offset, shape=(total,)) if total else np.zeros(0, dtype=np.uint64)
+        self.arrays = [data[entry["offset"]:entry["offset"] + entry["length"]] for entry in self.entries]
+
+    def find(self, checksum, params):
+        """
+            Return the cached sketch of a FASTA file with the given content checksum and parameters, or None. Sketches
+            are matched by contents, so a renamed or copied FASTA file reuses its sketch. Entries imported from the old
+            pickle cache have no checksum and never match here, see find_unverified().
+        """
+        for i, entry in enumerate(self.entries):
+            if entry["checksum"] == checksum and all(entry[key] == value for key, value in params.items()):
+                return self._sketch(entry, self.arrays[i])
+        return None
+
+    def find_unverified(self, name, params):
+        """
+            Return the sketch imported from the old pickle cache for the FASTA file name with the given parameters, or
+            None. Nothing recorded what it was built from, so it must be checked against a fresh sketch before use.
+        """
+        for i, entry in enumerate(self.entries):
+            if entry["checksum"] is None and entry["name"] == name and all(entry[key] == value for key, value in params.items()):
+                return self._sketch(entry, self.arrays[i])
+        return None
+
+    @staticmethod
+    def _sketch(entry, hashes):
+        """ Rebuild a sketch object around its stored hashes. """
+        if entry["scaled"]:
+            sketch = ScaledSketch(entry["scaled"], seed=entry["seed"], hashing=entry["hashing"])
+        else:
+            sketch = BottomKSketch(entry["sketch_size"], seed=entry["seed"], hashing=entry["hashing"])
+        sketch.hashes = hashes
+        return sketch
+
+    def add(self, name, checksum, params, sketch):
+        """ Add (or replace) the sketch of a FASTA file; call save() to write it out. """
+        for i, entry in enumerate(self.entries):
+            if entry["name"] == name and all(entry[key] == value for key, value in params.items()):
+                del self.entries[i], self.arrays[i]
+                break
+        self.entries.append(dict(name=name, checksum=checksum, **params))
+        self.arrays.append(np.asarray(sketch.get_hashes(), dtype=np.uint64))
+        self.added.add(self._identity(self.entries[-1]))
+        self.dirty = True
+
+    @staticmethod
+    def _identity(entry):
+        """ What add() replaces an entry by: the FASTA name and sketch parameters, but not where the hashes are. """
+        return tuple(sorted((key, value) for key, value in entry.items() if key not in ("checksum", "offset", "length")))
+
+    def save(self):
+        """
+            Write the database under a temporary name and rename it into place. The file is read again first and only
+            the sketches this run added replace its entries, so runs adding sketches at the same time do not drop each
+            other's. A save landing between another run's re-read and rename can still be lost, which costs a rebuild
+            later but never corrupts the file.
+        """
+        if os.path.exists(self.path):
+            on_disk = SketchDatabase(self.path)
+            kept = [i for i, entry in enumerate(on_disk.entries) if self._identity(entry) not in self.added]
+            ours = [i for i, entry in enumerate(self.entries) if self._identity(entry) in self.added]
+            self.entries = [on_disk.entries[i] for i in kept] + [self.entries[i] for i in ours]
+            self.arrays = [on_disk.arrays[i] for i in kept] + [self.arrays[i] for i in ours]
+        offset = 0
+        for entry, hashes in zip(self.entries, self.arrays):
+            entry["offset"], entry["length"] = offset, len(hashes)
+            offset += len(hashes)
+        header = json.dumps(self.entries).encode()
+        header += b"\0" * (-len(header) % 8)
+        tmp = self.path + ".tmp%d" % os.getpid()
+        with open(tmp, "wb") as f:
+            f.write(SKETCH_DB_MAGIC)
+            f.write(np.array([SKETCH_DB_VERSION, len(header)], dtype="<u8").tobytes())
+            f.write(header)
+            for hashes in self.arrays:
+                f.write(np.asarray(hashes, dtype="<u8").tobytes())
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def import_pickles(self, path):
+        """
+            Move the pickled sketches of older versions (one <FASTA name>[.canonical][.mix64][.scaled<S>].b file each)
+            into the database. Their k and contents were never recorded: k is taken to be LEGACY_K and the checksum is
+            left empty until build_ref_sketches has checked the sketch against its FASTA file.
+        """
+        for file in sorted(glob.glob(os.path.join(path, "*.b"))):
+            sketch = load_object_from_file(file)
+            if isinstance(sketch, MinHash):
+                sketch = BottomKSketch.from_minhash(sketch)
+            name = os.path.basename(file)[:-len(".b")]
+            canonical = False
+            for suffix in (f".scaled{getattr(sketch, 'scaled', None)}", ".mix64", ".canonical"):
+                if name.endswith(suffix):
+                    canonical = canonical or suffix == ".canonical"
+                    name = name[:-len(suffix)]
+            self.add(name, None, sketch_params(sketch, LEGACY_K, canonical), sketch)
+
+
+def kmer_tokens(kmers, k):
+    """
+        Turn 2-bit encoded k-mers into the tokens we hash: the ASCII bytes of each k-mer.
+        These hash exactly like the k-mer strings the cached sketches were built from.
+    """
+    buf = decode_kmers(kmers, k).tobytes()
+    return [buf[i:i + k] for i in range(0, len(buf), k)]
+
+def build_ref_sketches(fasta_objects, k, sketch_size, cache=True, canonical=False, hashing="xxhash", scaled=None):
     """
         Given a list of FASTA objects, create a MinHash sketch for each one (or load existing sketch from cache).
         Args:
             k - int, the k-mer size
             sketch_size - int, the number of hashes to store in each MinHash sketch
+            canonical - bool, sketch canonical k-mers so both strands are covered (cached apart from the forward-strand sketches)
+            hashing - str, "xxhash" or "mix64" (see BottomKSketch)
+            scaled - int, if set, build ScaledSketch sketches with this scale factor instead of bottom-k ones
+        Cached sketches live in the SketchDatabase file CACHE_PATH + SKETCH_DB, keyed by all of the above and a
+        checksum of the FASTA contents. Pickled sketches left by older versions are imported into it without a checksum;
+        the first time one would be used it is rebuilt instead, and replaced if it does not match.
     """
     ref_sketch_ids = []
     ref_sketches = []
+    db = SketchDatabase(CACHE_PATH + SKETCH_DB)
+    if cache and glob.glob(CACHE_PATH + "*.b"):
+        db.import_pickles(CACHE_PATH)
     for fasta in fasta_objects:
         sketch_id = "//".join(fasta.ids)
         filename = fasta.filename.split("/")[-1]
+        sketch = ScaledSketch(scaled, hashing=hashing) if scaled else BottomKSketch(sketch_size, hashing=hashing)
+        params = sketch_params(sketch, k, canonical)
+        checksum = fasta_checksum(fasta)
 
         # Try loading a cached ref sketch, if it exists. Else we will construct it from scratch.
-        try:
-            sketch = load_object_from_file(CACHE_PATH + filename + ".b")
-            ref_sketches.append(sketch)
+        cached = db.find(checksum, params)
+        if cached is not None:
+            ref_sketches.append(cached)
             ref_sketch_ids.append(sketch_id)
             continue
-        except FileNotFoundError:
+        unverified = db.find_unverified(filename, params)
+        if unverified is not None:
+            print(f"[WARNING] Cached sketch for '{filename}' does not record what it was built from. Rebuilding it once to check it...")
+        else:
             print(f"[WARNING] Could not find cached sketch for '{filename}'. Building from scratch...")
 
         # Break each fragment in the FASTA file into chunks and each chunk into k-mers and add it to our MinHash sketch
-        sketch = MinHash(sketch_size)
         for frag in fasta:
             # Break each fragment into kmers and create sketch
-            # For memory efficiency, we generate each k-mer one at a time and update the sketch in a stream
-            for i in range(len(frag) - k + 1):
-                kmer = frag[i: i + k]
-                sketch.update(kmer)
+            # For memory efficiency, we extract the k-mers one chunk at a time and update the sketch in a stream
+            codes = encode_bases(frag)
+            for start in range(0, len(codes) - k + 1, CHUNK_SIZE):
+                kmers, valid = kmer_codes(codes[start:start + CHUNK_SIZE + k - 1], k)
+                if canonical:
+                    kmers, _ = canonical_kmers(kmers, k)
+                sketch.update_kmers(kmers[valid], k)
 
         ref_sketches.append(sketch)
         ref_sketch_ids.append(sketch_id)
+        if unverified is not None and not np.array_equal(unverified.get_hashes(), sketch.get_hashes()):
+            print(f"[WARNING] Cached sketch for '{filename}' did not match the file and was stale; using the rebuilt one.")
 
         # If cache is set to True, save this sketch to disk
-        # Note that the _hasher attribute must be set to None to play nice with pickle.
         if cache:
-            sketch._hasher = None
-            save_object_to_file(sketch, CACHE_PATH + filename + ".b")
+            db.add(filename, checksum, params, sketch)
 
+    if cache and db.dirty:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        db.save()
+        for file in glob.glob(CACHE_PATH + "*.b"):
+            os.remove(file)
     return ref_sketches, ref_sketch_ids
 
 
-def classify_reads(fastq_obj, cont_ref_sketches, cont_ref_sketch_ids, des_ref_sketches, des_ref_sketch_ids, k, sketch_size):
-    """ Label each read as contaminated, desired, or other. """
+def classify_reads(fastq_obj, cont_ref_sketches, cont_ref_sketch_ids, des_ref_sketches, des_ref_sketch_ids, k, sketch_size, batch_size=100000, canonical=False, hashing="xxhash", exact=False):
+    """
+        Label each read as contaminated, desired, or other.
+        With exact set, each read's containment in every reference is computed exactly from all of its k-mers against
+        a SketchPanel of the reference sketches, a batch of reads at a time, instead of estimated from a read sketch.
+        Only hashes up to a sketch's threshold can be tested exactly. Against a bottom-k sketch of a large genome, a
+        short read usually has none, and its containment in that reference is then estimated from a read sketch as
+        without exact. Scaled sketches avoid this; a read with no hash a scaled sketch keeps scores 0 against it.
+    """
     results = {
         "Contaminated": [None for i in range(len(fastq_obj))],
         "Desired": [None for i in range(len(fastq_obj))],
         "Unassigned": [None for i in range(len(fastq_obj))]
     }
 
-    # Create MinHash sketch for each read in the file using its k-mers
-    for i, read in enumerate(fastq_obj):
-        # Create empty sketch for this read
-        read_sketch = MinHash(sketch_size)
-
-        # Break read into k-mers and populate the sketch
-        kmers = make_kmers(read["seq"], k)
-        for kmer in kmers:
-            read_sketch.update(kmer)
+    if exact:
+        ref_sketches = cont_ref_sketches + des_ref_sketches
+        panel = SketchPanel(ref_sketches)
+        n_cont = len(cont_ref_sketches)
+        n_estimated = 0
+
+    # Extract the k-mers of a whole batch of reads at once
+    seqs = fastq_obj.get_read_sequences()
+    for i in range(len(fastq_obj)):
+        if i % batch_size == 0:
+            batch = seqs[i:i + batch_size]
+            batch_kmers, batch_valid = kmer_codes(encode_reads(batch), k)
+            if canonical:
+                batch_kmers, _ = canonical_kmers(batch_kmers, k)
+            if exact:
+                scores, testable = panel.containment(*read_hashes(batch_kmers, batch_valid, k, hashing=hashing), len(batch))
+        read = fastq_obj[i]
+        row = i % batch_size
+
+        if exact:
+            # Estimate the containment in bottom-k sketches the read has no exactly testable hash against
+            row_scores = scores[row]
+            untestable = [r for r in np.flatnonzero(testable[row] == 0) if not isinstance(ref_sketches[r], ScaledSketch)]
+            if untestable:
+                read_sketch = BottomKSketch(sketch_size, hashing=hashing)
+                read_sketch.update_kmers(batch_kmers[row][batch_valid[row]], k)
+                row_scores = row_scores.copy()
+                row_scores[untestable] = [read_sketch.containment(ref_sketches[r]) for r in untestable]
+                n_estimated += 1
+            mean_cont_score = row_scores[:n_cont].max(initial=0)
+            mean_des_score = row_scores[n_cont:].max(initial=0)
+        else:
+            # Create a sketch of the read's k-mers
+            read_sketch = BottomKSketch(sketch_size, hashing=hashing)
+            read_sketch.update_kmers(batch_kmers[row][batch_valid[row]], k)
 
-        # Compare read sketch to each reference sketch and compute mean score
-        mean_cont_score = np.max([read_sketch.containment(cont_ref_sketch) for cont_ref_sketch in cont_ref_sketches])
-        mean_des_score = np.max([read_sketch.containment(des_ref_sketch) for des_ref_sketch in des_ref_sketches])
+            # Compare read sketch to each reference sketch and compute mean score
+            mean_cont_score = np.max([read_sketch.containment(cont_ref_sketch) for cont_ref_sketch in cont_ref_sketches])
+            mean_des_score = np.max([read_sketch.containment(des_ref_sketch) for des_ref_sketch in des_ref_sketches])
 
         # Compute max score (which reference this read likely came from)
         if mean_cont_score > mean_des_score:
@@ -219,6 +671,10 @@ def classify_reads(fastq_obj, cont_ref_sketches, cont_ref_sketch_ids, des_ref_sk
         else:
             results["Unassigned"][i] = read
 
+    if exact and n_estimated:
+        print(f"[WARNING] {n_estimated} of {len(fastq_obj)} reads had no k-mer hash small enough to test exactly against some "
+              "bottom-k reference sketch; their containment in it was estimated instead. Use scaled sketches for exact scores.")
+
     # Condense output lists to remove None values
     results["Contaminated"] = [r for r in results["Contaminated"] if r is not None]
     results["Desired"] = [r for r in results["Desired"] if r is not None]
@@ -227,10 +683,11 @@ def classify_reads(fastq_obj, cont_ref_sketches, cont_ref_sketch_ids, des_ref_sk
     return results
 
 
-def minhash_engine(cont_fasta_objs, des_fasta_objs, fastq_obj, k=21, sketch_size=1000):
+def minhash_engine(cont_fasta_objs, des_fasta_objs, fastq_obj, k=21, sketch_size=1000, canonical=False, hashing="xxhash", exact=False, scaled=None):
+    # scaled, if set, sketches references with ScaledSketch and classifies reads by exact lookup of their retained hashes
     # Build sketches for each reference genome, contaminants and desired
-    cont_ref_sketches, cont_ref_sketch_ids = build_ref_sketches(cont_fasta_objs, k, sketch_size, cache=True)
-    des_ref_sketches, des_ref_sketch_ids = build_ref_sketches(des_fasta_objs, k, sketch_size, cache=True)
+    cont_ref_sketches, cont_ref_sketch_ids = build_ref_sketches(cont_fasta_objs, k, sketch_size, cache=True, canonical=canonical, hashing=hashing, scaled=scaled)
+    des_ref_sketches, des_ref_sketch_ids = build_ref_sketches(des_fasta_objs, k, sketch_size, cache=True, canonical=canonical, hashing=hashing, scaled=scaled)
 
     # For each sequencing read in each FASTQ file, identify whether it is a contaminant or not
     results = classify_reads(
@@ -240,6 +697,9 @@ def minhash_engine(cont_fasta_objs, des_fasta_objs, fastq_obj, k=21, sketch_size
         des_ref_sketches,
         des_ref_sketch_ids,
         k,
-        sketch_size)
+        sketch_size,
+        canonical=canonical,
+        hashing=hashing,
+        exact=exact or scaled is not None)
 
     return results